@@ -0,0 +1,311 @@
+"""Benchmarks of the webapp, the crawler parsers and the caches.
+
+The benchmarks run offline. The webapp is benchmarked with synthetic
+elections and the crawlers parse synthetic fixture pages that mimic the
+pages of the CEO sites, served from an in-process handler instead of the
+network.
+
+Usage:
+
+    python benchmark.py [-o results.json] [--quick]
+    python benchmark.py --compare old.json new.json
+
+The results are written as JSON, with the min, median and mean time in
+seconds of each benchmark, so that results of two revisions can be compared.
+"""
+import os
+import time
+import shutil
+import urllib
+import urllib2
+import urlparse
+import httplib
+import logging
+import optparse
+import platform
+import tempfile
+import StringIO
+import subprocess
+import simplejson
+from timeit import default_timer as timer
+
+import webapp
+import storage
+from crawlers import base, httpcache, AE_2011_KL, AE_2011_PY, AE_2011_WB
+from crawlers.metrics import Metrics
+
+logger = logging.getLogger("benchmark")
+
+def measure(name, f, min_time=0.2, max_repeat=1000, **params):
+    """Calls f repeatedly and returns the timings.
+
+    f is called at least once and until min_time seconds are spent or it has been called max_repeat times.
+    """
+    times = []
+    while not times or (sum(times) < min_time and len(times) < max_repeat):
+        t0 = timer()
+        f()
+        times.append(timer() - t0)
+    times.sort()
+    result = {
+        "name": name,
+        "params": params,
+        "repeat": len(times),
+        "min": times[0],
+        "median": times[len(times)//2],
+        "mean": sum(times) / len(times),
+    }
+    logger.info("%s %s: %.6fs", name, params, result['median'])
+    return result
+
+def make_response(url, body, content_type="text/html"):
+    headers = httplib.HTTPMessage(StringIO.StringIO("Content-Type: %s\r\nContent-Length: %d\r\n" % (content_type, len(body))))
+    response = urllib.addinfourl(StringIO.StringIO(body), headers, url)
+    response.code = 200
+    response.msg = "OK"
+    return response
+
+class FixtureHandler(urllib2.BaseHandler):
+    """Serves responses from a function instead of the network.
+
+    The function is called with the url and returns the body.
+    """
+    # run before the default HTTPHandler
+    handler_order = 400
+
+    def __init__(self, get_body):
+        self.get_body = get_body
+
+    def http_open(self, request):
+        url = request.get_full_url()
+        return make_response(url, self.get_body(url))
+
+def make_crawler(cls, root, get_body):
+    crawler = cls(root)
+    crawler.opener = urllib2.build_opener(httpcache.CacheHandler(crawler.cache_dir), FixtureHandler(get_body))
+    return crawler
+
+def get_query(url):
+    return dict(urlparse.parse_qsl(urlparse.urlparse(url).query))
+
+## synthetic data
+
+def make_election(n, candidates=10):
+    return {
+        "_id": "AE-BENCH-%d" % n,
+        "state": "Bench",
+        "election_type": "assembly",
+        "year": "2011",
+        "url": "http://example.com/",
+        "constituencies": [{
+            "id": str(i),
+            "name": "Constituency %d" % i,
+            "district": "District %d" % (i / 10),
+            "district_id": str(i / 10),
+            "candidates": [{
+                "id": str(j),
+                "name": "Candidate %d-%d" % (i, j),
+                "party": "Party %d" % (j % 7),
+                "affidavits": [{
+                    "name": "affidavit",
+                    "filename": "files/%d-%d.pdf" % (i, j),
+                    "url": "http://example.com/%d-%d.pdf" % (i, j)
+                }]
+            } for j in range(candidates)]
+        } for i in range(1, n+1)]
+    }
+
+def kl_page(url, districts=14, constituencies=10, candidates=10):
+    if url.endswith("districtlacs.html"):
+        rows = "".join('<tr><td>%d</td><td><a href="http://www.ceo.kerala.gov.in/district%d.html">District %d</a></td></tr>' % (i, i, i)
+                       for i in range(1, districts+1))
+        return '<div class="content inner-width"><table><tr><th>No</th><th>District</th></tr>%s</table></div>' % rows
+    elif "partsListAjax" in url:
+        cid = get_query(url)['lacNo']
+        rows = [[str(j), "Candidate %s-%d" % (cid, j), "Party %d" % j,
+                 '<a href="http://www.ceo.kerala.gov.in:80/affidavits/%s/%d.pdf">view</a>' % (cid, j)]
+                for j in range(candidates)]
+        return simplejson.dumps({"aaData": rows})
+    else:
+        rows = "".join('<tr><td>%d</td><td>x</td><td>%d Constituency %d</td><td>y</td></tr>' % (i, i, i)
+                       for i in range(1, constituencies+1))
+        return ('<div class="content inner-width"><table><tr><th>h</th></tr>'
+                '<tr><td>a</td><td>b</td><td>%d</td></tr>%s</table></div>') % (constituencies, rows)
+
+def py_page(url, constituencies=30, candidates=10):
+    def candidate(j):
+        return ('<tr><td>%d</td><td>Candidate %d</td><td>Party</td><td>M</td>'
+                '<td><a href="AFFIDAVITS\\%d-a.pdf">A</a></td><td><a href="AFFIDAVITS\\%d-c.pdf">C</a></td></tr>') % (j, j, j, j)
+    sections = "".join('<p align="center" style="text-align:center">%02d. CONSTITUENCY (GEN)</p>'
+                       '<table><tr><td>h</td></tr><tr><td>h</td></tr>%s</table>' % (i, "".join(candidate(j) for j in range(candidates)))
+                       for i in range(1, constituencies+1))
+    return '<div class="Section1">%s</div>' % sections
+
+def wb_page(url, districts=19, constituencies=15, candidates=10):
+    if "districtlistaffidavits" in url:
+        return "".join('<a href="ACLISTAffidavits.aspx?DCID=%d">District %d</a>' % (i, i) for i in range(1, districts+1))
+    elif "ACLISTAffidavits" in url:
+        return "".join('<a href="CandidateAffidavitsForAc.aspx?ACID=%d">%d-Constituency</a>' % (i, i) for i in range(1, constituencies+1))
+    else:
+        link = "ViewCandidateAffidavits.aspx?AffidavitsID"
+        if "ExpenditureMonitoringForAc" in url:
+            link = "ViewExpenditureMonitoring.aspx?ID"
+        rows = "".join('<tr><td>%d</td><td>Candidate %d</td><td>M</td><td>Party</td><td><a href="%s=%d">view</a></td></tr>' % (j, j, link, j)
+                       for j in range(candidates))
+        return '<table id="ctl00_ContentPlaceHolder1_GridView1"><tr><th>h</th></tr>%s</table>' % rows
+
+## benchmarks
+
+def bench_webapp(tmpdir, sizes):
+    results = []
+    for name, store in [("json", storage.JSONStore(os.path.join(tmpdir, "db"))),
+                        ("sqlite", storage.SQLiteStore(os.path.join(tmpdir, "elections.db")))]:
+        webapp.store = store
+        for n in sizes:
+            data = make_election(n)
+            if name == "json":
+                if not os.path.exists(store.root):
+                    os.makedirs(store.root)
+                with open(os.path.join(store.root, data['_id'] + ".json"), "w") as f:
+                    f.write(simplejson.dumps(data))
+            else:
+                store.import_election(data)
+
+            eid = data['_id']
+            cid = str(n / 2 + 1)
+            results.append(measure("election_get", lambda: webapp.Election.get(eid), store=name, constituencies=n))
+            for page, path in [("index", "/"), ("election", "/" + eid), ("constituency", "/%s/C%s" % (eid, cid))]:
+                # cold renders the page every time, warm serves it from the page cache
+                results.append(measure("webapp_" + page, cold_request(path), store=name, constituencies=n, cache="cold"))
+                results.append(measure("webapp_" + page, lambda: webapp.app.request(path), store=name, constituencies=n, cache="warm"))
+    return results
+
+def cold_request(path):
+    def f():
+        webapp.page_cache.clear()
+        return webapp.app.request(path)
+    return f
+
+def bench_crawlers(tmpdir):
+    results = []
+    def run(name, crawler, f, *args):
+        f(crawler, *args) # warm up the cache
+        results.append(measure("parse_" + name, lambda: f(crawler, *args)))
+
+    kl = make_crawler(AE_2011_KL.Crawler, os.path.join(tmpdir, "KL"), kl_page)
+    run("kl_districts", kl, AE_2011_KL.Crawler.get_districts.__wrapped__)
+    run("kl_constituencies", kl, AE_2011_KL.Crawler.get_constituencies.__wrapped__, "1", "http://www.ceo.kerala.gov.in/district1.html")
+    run("kl_candidates", kl, AE_2011_KL.Crawler.get_candidates.__wrapped__, "1", "1")
+
+    py = make_crawler(AE_2011_PY.Crawler, os.path.join(tmpdir, "PY"), py_page)
+    run("py_constituencies", py, AE_2011_PY.Crawler.get_constituencies)
+
+    wb = make_crawler(AE_2011_WB.Crawler, os.path.join(tmpdir, "WB"), wb_page)
+    run("wb_districts", wb, AE_2011_WB.Crawler.get_districts.__wrapped__)
+    run("wb_constituencies", wb, AE_2011_WB.Crawler.get_constituencies.__wrapped__, "1")
+    run("wb_candidates", wb, AE_2011_WB.Crawler.get_candidates.__wrapped__, "1")
+    run("wb_expenditure", wb, AE_2011_WB.Crawler.get_expenditure_for_ac.__wrapped__, "1")
+    return results
+
+def bench_cache(tmpdir):
+    cache_dir = os.path.join(tmpdir, "cache")
+    body = wb_page("http://example.com/candidates", candidates=50)
+    opener = urllib2.build_opener(httpcache.CacheHandler(cache_dir), FixtureHandler(lambda url: body))
+
+    counter = [0]
+    def miss():
+        counter[0] += 1
+        opener.open("http://example.com/miss/%d" % counter[0]).read()
+    opener.open("http://example.com/hit").read()
+    return [
+        measure("cache_hit", lambda: opener.open("http://example.com/hit").read()),
+        measure("cache_miss", miss),
+    ]
+
+def bench_disk_memoize(tmpdir):
+    class Memoized:
+        root = os.path.join(tmpdir, "memoize")
+        metrics = Metrics()
+
+        @base.disk_memoize("data/%(i)s.json")
+        def get(self, i):
+            return make_election(5)
+
+    m = Memoized()
+    counter = [0]
+    def miss():
+        counter[0] += 1
+        m.get(counter[0])
+    m.get(0)
+    return [
+        measure("disk_memoize_hit", lambda: m.get(0)),
+        measure("disk_memoize_miss", miss),
+        measure("disk_memoize_baseline", lambda: Memoized.get.__wrapped__(m, 0)),
+    ]
+
+def get_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(sizes):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        results = []
+        results += bench_webapp(tmpdir, sizes)
+        results += bench_crawlers(tmpdir)
+        results += bench_cache(tmpdir)
+        results += bench_disk_memoize(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+    return {
+        "revision": get_revision(),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+def compare(old, new):
+    """Prints median times of two benchmark runs side by side.
+    """
+    def key(r):
+        return r['name'], tuple(sorted(r['params'].items()))
+    old_results = dict((key(r), r) for r in old['results'])
+    print "%-60s %12s %12s %8s" % ("benchmark", "old", "new", "ratio")
+    for r in new['results']:
+        name = r['name'] + " " + " ".join("%s=%s" % kv for kv in sorted(r['params'].items()))
+        o = old_results.get(key(r))
+        if o:
+            print "%-60s %12.6f %12.6f %8.2f" % (name, o['median'], r['median'], r['median'] / o['median'])
+        else:
+            print "%-60s %12s %12.6f" % (name, "-", r['median'])
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [-o results.json] [--quick] | --compare old.json new.json")
+    parser.add_option("-o", "--output", help="file to write the results to")
+    parser.add_option("--quick", action="store_true", help="use only small synthetic elections")
+    parser.add_option("--compare", action="store_true", help="compare two result files")
+    options, args = parser.parse_args()
+
+    if options.compare:
+        old, new = [simplejson.loads(open(path).read()) for path in args]
+        compare(old, new)
+        return
+
+    FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
+    # the crawlers log every request and every file they read
+    logging.basicConfig(format=FORMAT, level=logging.WARN)
+    logger.setLevel(logging.INFO)
+
+    sizes = options.quick and [10, 100] or [10, 100, 1000, 10000]
+    results = run_benchmarks(sizes)
+    json = simplejson.dumps(results, indent=4)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(json)
+    else:
+        print json
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,259 @@
-import couchdb
-import simplejson
+"""Loads election data into CouchDB.
+
+Each election is split into one document for the election and one document
+per constituency, with ids "<eid>" and "<eid>/C<cid>". The documents are
+pushed using _bulk_docs in batches. The existing revisions are fetched with
+a single _all_docs request and the documents whose content hasn't changed
+are skipped. The content hashes used to find the unchanged documents are
+kept in a small side document "<eid>/hashes", so that the documents
+themselves never have to be fetched. The side document also lists the
+documents loaded before, and those that are not in the data any more,
+like a constituency removed from the crawl, are deleted.
+
+Usage:
+
+    python couchload.py data/AE-2011-KL/data.json [http://127.0.0.1:5984/electionarchive]
+"""
 import sys
+import logging
+import hashlib
+import urllib
+import urllib2
+import threading
+import simplejson
+import BaseHTTPServer
+
+logger = logging.getLogger("couchload")
+
+DB_URL = "http://127.0.0.1:5984/electionarchive"
+
+def split_election(data):
+    """Splits the election data into an election document and a document for each constituency.
+    """
+    eid = data['_id']
+    election = dict((k, v) for k, v in data.items() if k != "constituencies")
+    election['type'] = "election"
+    election['constituencies'] = []
+    yield election
+
+    for c in data['constituencies']:
+        election['constituencies'].append({
+            "id": c['id'],
+            "name": c['name'],
+            "district": c.get("district")
+        })
+        doc = dict(c)
+        doc['_id'] = "%s/C%s" % (eid, c['id'])
+        doc['type'] = "constituency"
+        doc['election_id'] = eid
+        yield doc
+
+def content_hash(doc):
+    d = dict((k, v) for k, v in doc.items() if k != "_rev")
+    return hashlib.sha1(simplejson.dumps(d, sort_keys=True)).hexdigest()
+
+class BulkLoader:
+    """Loads documents into a CouchDB database using the bulk API.
+    """
+    def __init__(self, db_url=DB_URL, batch_size=500):
+        self.db_url = db_url.rstrip("/")
+        self.batch_size = batch_size
+
+    def request(self, path, data):
+        req = urllib2.Request(self.db_url + path, simplejson.dumps(data), {"Content-Type": "application/json"})
+        return simplejson.loads(urllib2.urlopen(req).read())
+
+    def get(self, id):
+        """Returns the document with given id or None if it is not in the database.
+        """
+        try:
+            return simplejson.loads(urllib2.urlopen(self.db_url + "/" + urllib.quote(id, safe="")).read())
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return None
+            raise
+
+    def get_revisions(self, ids):
+        """Returns a dict mapping id to rev for all the ids present in the database.
+        """
+        d = self.request("/_all_docs", {"keys": ids})
+        return dict((row['id'], row['value']['rev'])
+                    for row in d['rows']
+                    if 'value' in row and not row['value'].get('deleted'))
+
+    def load(self, docs, hashes_id):
+        """Saves the docs to the database, skipping the unchanged ones.
+
+        The content hashes of the docs are kept in the document hashes_id.
+        The docs saved by an earlier load with the same hashes_id that are
+        not in docs are deleted. Returns the number of documents saved or deleted.
+        """
+        docs = list(docs)
+        hashes_doc = self.get(hashes_id) or {"_id": hashes_id, "type": "hashes", "hashes": {}}
+        hashes = hashes_doc['hashes']
+        ids = set(doc['_id'] for doc in docs)
+        removed = [id for id in sorted(hashes) if id not in ids]
+        revs = self.get_revisions([doc['_id'] for doc in docs] + removed)
+
+        changed = []
+        for id in removed:
+            if id in revs:
+                changed.append({"_id": id, "_rev": revs[id], "_deleted": True})
+            else:
+                del hashes[id]
+        for doc in docs:
+            hash = content_hash(doc)
+            rev = revs.get(doc['_id'])
+            if rev and hashes.get(doc['_id']) == hash:
+                continue
+            if rev:
+                doc['_rev'] = rev
+            hashes[doc['_id']] = hash
+            changed.append(doc)
+
+        logger.info("saving %d of %d documents, deleting %d", len(changed) - len(removed), len(docs), len(removed))
+        saved = 0
+        for i in range(0, len(changed), self.batch_size):
+            batch = changed[i:i+self.batch_size]
+            for row in self.request("/_bulk_docs", {"docs": batch}):
+                if "error" in row:
+                    logger.error("failed to save %s: %s", row['id'], row['error'])
+                    # try it again next time, a failed delete stays in hashes for that
+                    if row['id'] in ids:
+                        hashes.pop(row['id'], None)
+                else:
+                    saved += 1
+                    if row['id'] not in ids:
+                        hashes.pop(row['id'], None)
+
+        if changed:
+            for row in self.request("/_bulk_docs", {"docs": [hashes_doc]}):
+                if "error" in row:
+                    logger.error("failed to save %s: %s, all the documents will be saved again on the next load",
+                                 row['id'], row['error'])
+        return saved
+
+def load(path, db_url=DB_URL):
+    data = simplejson.loads(open(path).read())
+    return BulkLoader(db_url).load(split_election(data), data['_id'] + "/hashes")
+
+def main():
+    FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    db_url = len(sys.argv) > 2 and sys.argv[2] or DB_URL
+    load(sys.argv[1], db_url)
+
+class FakeCouchDB(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in for CouchDB supporting only getting a document, _all_docs and _bulk_docs.
+    """
+    docs = {}
+    requests = []
+    # ids of the documents to fail with a conflict
+    conflicts = set()
+
+    def do_GET(self):
+        self.requests.append("GET " + self.path)
+        id = urllib.unquote(self.path.split("/", 2)[2])
+        if id in self.docs:
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(simplejson.dumps(self.docs[id]))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        data = simplejson.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.requests.append("POST " + self.path)
+
+        if self.path.endswith("/_all_docs"):
+            rows = [{"id": id, "key": id, "value": {"rev": self.docs[id]['_rev']}}
+                    for id in data['keys'] if id in self.docs]
+            result = {"rows": rows}
+        else:
+            result = []
+            for doc in data['docs']:
+                old = self.docs.get(doc['_id'])
+                if (old and old['_rev'] != doc.get('_rev')) or doc['_id'] in self.conflicts:
+                    result.append({"id": doc['_id'], "error": "conflict"})
+                    continue
+                if doc.get('_deleted'):
+                    del self.docs[doc['_id']]
+                    result.append({"id": doc['_id'], "rev": doc['_rev']})
+                    continue
+                doc['_rev'] = str(int(old and old['_rev'] or 0) + 1)
+                self.docs[doc['_id']] = doc
+                result.append({"id": doc['_id'], "rev": doc['_rev']})
+
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(simplejson.dumps(result))
+
+    def log_message(self, *a):
+        pass
+
+class TestBulkLoader:
+    def setup_method(self, method):
+        FakeCouchDB.docs = {}
+        FakeCouchDB.requests = []
+        FakeCouchDB.conflicts = set()
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FakeCouchDB)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.loader = BulkLoader("http://127.0.0.1:%d/electionarchive" % self.server.server_port, batch_size=2)
+
+    def teardown_method(self, method):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_data(self, name="Foo"):
+        return {
+            "_id": "AE-2011-XX",
+            "constituencies": [
+                {"id": "1", "name": name, "candidates": []},
+                {"id": "2", "name": "Bar", "candidates": []},
+            ]
+        }
+
+    def load(self, name="Foo", data=None):
+        return self.loader.load(split_election(data or self.get_data(name)), "AE-2011-XX/hashes")
+
+    def test_load(self):
+        assert self.load() == 3
+        assert sorted(FakeCouchDB.docs) == ["AE-2011-XX", "AE-2011-XX/C1", "AE-2011-XX/C2", "AE-2011-XX/hashes"]
+        assert FakeCouchDB.requests == [
+            "GET /electionarchive/AE-2011-XX%2Fhashes",
+            "POST /electionarchive/_all_docs",
+            "POST /electionarchive/_bulk_docs",
+            "POST /electionarchive/_bulk_docs",
+            "POST /electionarchive/_bulk_docs"]
+
+        # only changed documents are saved again
+        assert self.load() == 0
+        assert self.load("Foo2") == 2
+        assert FakeCouchDB.docs["AE-2011-XX/C1"]['_rev'] == "2"
+        assert FakeCouchDB.docs["AE-2011-XX/C2"]['_rev'] == "1"
+        assert "content_hash" not in FakeCouchDB.docs["AE-2011-XX/C1"]
+
+    def test_deleted(self):
+        self.load()
+        del FakeCouchDB.docs["AE-2011-XX/C2"]
+        assert self.load() == 1
 
-def load(path):
-    db = couchdb.Database("http://127.0.0.1:5984/electionarchive")
+    def test_removed(self):
+        self.load()
+        data = self.get_data()
+        del data['constituencies'][1]
+        # the election document changes and C2 is deleted
+        assert self.load(data=data) == 2
+        assert sorted(FakeCouchDB.docs) == ["AE-2011-XX", "AE-2011-XX/C1", "AE-2011-XX/hashes"]
+        assert sorted(FakeCouchDB.docs["AE-2011-XX/hashes"]["hashes"]) == ["AE-2011-XX", "AE-2011-XX/C1"]
 
-    doc = simplejson.loads(open(path).read())
-    olddoc = db.get(doc['_id']) or {}
-    if "_rev" in olddoc:
-        doc['_rev'] = olddoc['_rev']
-    db.save(doc)
+    def test_hashes_conflict(self, caplog):
+        FakeCouchDB.conflicts = set(["AE-2011-XX/hashes"])
+        assert self.load() == 3
+        assert "failed to save AE-2011-XX/hashes" in caplog.text
 
 if __name__ == "__main__":
-    load(sys.argv[1])
+    main()
@@ -6,46 +6,52 @@ import BeautifulSoup
 import logging
 import simplejson
 import os
+import functools
+import optparse
 
 from base import BaseCrawler, disk_memoize
+from profiler import profile
 
 logger = logging.getLogger("kerala")
 
 class Crawler(BaseCrawler):
     url = "http://www.ceo.kerala.gov.in/affidavit.html"
     
-    @disk_memoize("data.json")
-    def get_data(self):
+    def crawl_data(self):
         """Returns the data in data.json format.
         """
-        d = {
+        return {
             "_id": "AE-2011-KL",
             "state": "Kerala",
             "election_type": "assembly",
             "year": "2011",
             "url": "http://www.ceo.kerala.gov.in/affidavit.html",
-            "constituencies": []
+            "constituencies": self.get_all_constituencies()
         }
         
+    def get_all_constituencies(self):
         for dist in self.get_districts():
             for c in dist['constituencies']:
                 c['candidates'] = self.get_candidates(c['id'], dist['id'])
                 c['district'] = dist['name']
                 c['district_id'] = dist['id']
-                d['constituencies'].append(c)
-        return d
+                yield c
         
     def download_files(self):
+        for url, download in self.get_downloads():
+            download()
+        self.run_parked()
+        
+    def get_downloads(self):
         for filename, url in self.get_files_to_download():
             # download adds files/ to the path. Stripping that off to balance.
             filename = filename[len("files/"):]
-            self.download(url, path=filename)
+            yield url, functools.partial(self.download, url, path=filename)
     
     def get_files_to_download(self):
         """Returns an iterator over (filename, url) for all downloadable urls.
         """
-        d = self.get_data()
-        for cons in d['constituencies']:
+        for cons in self.iter_constituencies():
             for c in cons['candidates']:
                 for a in c['affidavits']:
                     yield a['filename'], a['url']
@@ -124,12 +130,22 @@ class Crawler(BaseCrawler):
         return [parse_candidate(c) for c in d['aaData']]
                 
 def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--profile", metavar="DIR", help="profile the crawl and write the profile to DIR")
+    options, args = parser.parse_args()
+
     FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
     logging.basicConfig(format=FORMAT, level=logging.INFO)
     
     crawler = Crawler("data/AE-2011-KL")
-    crawler.get_data()
-    crawler.download_files()
+    with profile(options.profile, crawler.metrics):
+        with crawler.metrics.timer("metadata"):
+            crawler.ensure_data()
+        with crawler.metrics.timer("downloads"):
+            crawler.download_files()
+    
+    crawler.metrics.log_summary()
+    crawler.metrics.dump(os.path.join(crawler.root, "metrics.json"))
         
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,10 +1,14 @@
 """Crawler of 2011 Assembly Elections in Puducherry.
 """
 import logging
+import os
+import functools
+import optparse
 import re
 import urllib
 
 from base import BaseCrawler, disk_memoize
+from profiler import profile
 
 logger = logging.getLogger("crawl")
 
@@ -12,8 +16,7 @@ class Crawler(BaseCrawler):
     url = "http://www.ceopondicherry.nic.in/AFFIDAVITS2011/puducherry.asp"
     RE_CONSTITUENCY_NAME = re.compile(r"^(\d+) *[\.-] *([A-Za-z\. ]*) *(?:\(([A-Z]*)\))?$")
     
-    @disk_memoize("data.json")
-    def get_data(self):
+    def crawl_data(self):
         """Returns the data in data.json format.
         """
         return {
@@ -123,8 +126,8 @@ class Crawler(BaseCrawler):
                 "name": name,
                 "category": category,
                 "winner": winner and _parse_link(winner),
-                "runner1": winner and _parse_link(runner1),
-                "runner2": winner and _parse_link(runner2),
+                "runner1": runner1 and _parse_link(runner1),
+                "runner2": runner2 and _parse_link(runner2),
             }
                     
         return [parse(tr) for tr in rows]
@@ -135,7 +138,7 @@ class Crawler(BaseCrawler):
         return tuple(s and s.strip() for s in match.groups())
         
     def get_downloadables(self):
-        for cons in self.get_data()['constituencies']:
+        for cons in self.iter_constituencies():
             for c in cons['candidates']:
                 for a in c['affidavits']:
                     yield a['filename'], a['url']
@@ -145,21 +148,41 @@ class Crawler(BaseCrawler):
 
         for cons in self.get_expenditures():
             for key in ['winner', 'runner1', 'runner2']:
-                if key in cons:
+                # the key is always there, but is None when the column has no link
+                if cons[key]:
                     yield cons[key]['filename'], cons[key]['url']
 
-    def download_all(self):
+    def crawl_metadata(self):
+        self.ensure_data()
+        self.get_results()
+        self.get_expenditures()
+        
+    def get_downloads(self):
         for filename, url in self.get_downloadables():
             # download adds files/ to the filename. removing here to balance it.
             filename = filename[len("files/"):]
-            self.download(url, path=filename)
+            yield url, functools.partial(self.download, url, path=filename)
+
+    def download_all(self):
+        for url, download in self.get_downloads():
+            download()
+        self.run_parked()
 
 def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--profile", metavar="DIR", help="profile the crawl and write the profile to DIR")
+    options, args = parser.parse_args()
+
     FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
     logging.basicConfig(format=FORMAT, level=logging.INFO)
     
     crawler = Crawler("data/AE-2011-PY")
-    crawler.download_all()
+    with profile(options.profile, crawler.metrics):
+        with crawler.metrics.timer("downloads"):
+            crawler.download_all()
+    
+    crawler.metrics.log_summary()
+    crawler.metrics.dump(os.path.join(crawler.root, "metrics.json"))
     
 class TestCrawler:
     """py.test test
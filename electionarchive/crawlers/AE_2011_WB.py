@@ -2,37 +2,54 @@
 """
 
 import logging
+import os
+import functools
+import optparse
 import re
 import urllib
 
-from base import BaseCrawler, disk_memoize
+from base import BaseCrawler, PostbackSession, disk_memoize
+from profiler import profile
+from retry import HostUnavailable
 
 logger = logging.getLogger("crawler")
 
 class Crawler(BaseCrawler):
-    url = "http://www.ceo.kerala.gov.in/affidavit.html"
+    url = "http://www.ceowb.in/districtlistaffidavits.aspx"
 
-    @disk_memoize("data.json")
-    def get_data(self):
+    def crawl_data(self):
         """Returns the data in data.json format.
         """
-        d = {
+        return {
             "_id": "AE-2011-WB",
             "state": "West Bengal",
             "election_type": "assembly",
             "year": "2011",
             "url": "http://www.ceowb.in/districtlistaffidavits.aspx",
-            "constituencies": list(self.get_all_constituencies())
+            "constituencies": self.get_all_constituencies()
         }
-        return d
         
     def download_all(self):
+        for url, download in self.get_downloads():
+            download()
+        self.run_parked()
+        
+    def crawl_metadata(self):
+        self.ensure_data()
+        self.get_links()
+        self.get_expenditure_monitoring()
+        
+    def get_downloads(self):
         for c in self.get_all_candidates():
-            logger.info("downloading affidavits of %s (%s/%s)" % (c['name'], c['constituency_id'], c['id']))
-            self.download_affidavits(c['affidavit_id'])
+            url = "http://www.ceowb.in/ViewCandidateAffidavits.aspx?AffidavitsID=" + str(c['affidavit_id'])
+            yield url, functools.partial(self.run_or_park, self.download_affidavits, c['affidavit_id'])
             
-        self.download_links()
-        self.download_expenditures()
+        for link in self.get_links():
+            yield link['url'], functools.partial(self.download, link['url'], path=link['filename'])
+            
+        for cons in self.get_expenditure_monitoring():
+            for c in cons:
+                yield c['download_url'], functools.partial(self.run_or_park, self._download_expenditures_for_ac, c['download_id'])
             
     def get_all_constituencies(self):
         for dist in self.get_districts():
@@ -43,8 +60,7 @@ class Crawler(BaseCrawler):
                 yield c
         
     def get_all_candidates(self):
-        d = self.get_data()
-        for cons in d['constituencies']:
+        for cons in self.iter_constituencies():
             for c in cons['candidates']:
                 c['constituency_id'] = cons['id']
                 yield c
@@ -133,19 +149,20 @@ class Crawler(BaseCrawler):
         return [parse(tr) for tr in rows]
     
     def download_affidavits(self, AffidavitsID):
+        logger.info("downloading affidavits %s", AffidavitsID)
         url = "http://www.ceowb.in/ViewCandidateAffidavits.aspx?AffidavitsID=" + str(AffidavitsID)
-        soup = self.get_soup(url)
-        inputs = soup.findAll("input", {"type": "hidden"})
-        formdata = dict((i['name'], i['value']) for i in inputs)
+        session = PostbackSession(self, url)
         
-        post_links = [a for a in soup.findAll("a") if a['href'].startswith("javascript:__doPostBack")]
-        for link in post_links:
-            suffix = self.get_suffix_from_jslink(link['href'])
-            target = link['href'].split("'")[1]
+        def download(href):
+            suffix = self.get_suffix_from_jslink(href)
             try:
-                self._download_affidavit(AffidavitsID, suffix, formdata, target)
+                self._download_affidavit(AffidavitsID, suffix, session, session.get_target(href))
+            except HostUnavailable:
+                raise
             except Exception:
                 logger.error("failed to download files/%s-%s.pdf", AffidavitsID, suffix, exc_info=True)
+        for href in session.get_postback_links():
+            download(href)
             
     def get_suffix_from_jslink(self, link, suffix_map={}):
         """Returns file suffix from href.
@@ -177,15 +194,8 @@ class Crawler(BaseCrawler):
             return suffix + "-" + count
         
     @disk_memoize("files/%(AffidavitsID)s-%(suffix)s.pdf")
-    def _download_affidavit(self, AffidavitsID, suffix, formdata, target):
-        url = "http://www.ceowb.in/ViewCandidateAffidavits.aspx?AffidavitsID=" + str(AffidavitsID)
-        data = dict(formdata)
-        data['__EVENTTARGET'] = target
-        return self.post(url, data)
-        
-    def download_links(self):
-        for link in self.get_links():
-            self.download(link['url'], path=link['filename'])
+    def _download_affidavit(self, AffidavitsID, suffix, session, target):
+        return session.postback(target, _cache=True)
         
     @disk_memoize("data/links.json")
     def get_links(self):
@@ -216,34 +226,24 @@ class Crawler(BaseCrawler):
                 url = "http://ceowestbengal.nic.in/" + href
                 yield title, filename, url
                 
-    def download_expenditures(self):
-        for cons in self.get_expenditure_monitoring():
-            for c in cons:
-                print "c", c
-                self._download_expenditures_for_ac(c['download_id'])
-        
     def _download_expenditures_for_ac(self, id):
         url = "http://www.ceowb.in/ViewExpenditureMonitoring.aspx?ID=" + str(id)
-        soup = self.get_soup(url)
-        inputs = soup.findAll("input", {"type": "hidden"})
-        formdata = dict((i['name'], i['value']) for i in inputs)
+        session = PostbackSession(self, url)
         
-        post_links = [a for a in soup.findAll("a") if a['href'].startswith("javascript:__doPostBack")]
-
-        for link in post_links:
-            suffix = self.get_suffix_from_jslink(link['href'], suffix_map={"CR": "abstract", "SC": "affidavit"})
-            target = link['href'].split("'")[1]
+        def download(href):
+            suffix = self.get_suffix_from_jslink(href, suffix_map={"CR": "abstract", "SC": "affidavit"})
             try:
-                self._download_expenditure(id, suffix, formdata, target)
+                self._download_expenditure(id, suffix, session, session.get_target(href))
+            except HostUnavailable:
+                raise
             except IOError:
                 logger.error("Downloading expediture failed", exc_info=True)
+        for href in session.get_postback_links():
+            download(href)
             
     @disk_memoize("files/expediture/%(id)s-%(suffix)s.pdf")
-    def _download_expenditure(self, id, suffix, formdata, target):
-        url = "http://www.ceowb.in/ViewExpenditureMonitoring.aspx?ID=" + str(id)
-        data = dict(formdata)
-        data['__EVENTTARGET'] = target
-        return self.post(url, data)            
+    def _download_expenditure(self, id, suffix, session, target):
+        return session.postback(target, _cache=True)
                 
     def get_expenditure_monitoring(self):
         return [self.get_expenditure_for_ac(c['id']) for c in list(self.get_all_constituencies())]
@@ -281,14 +281,24 @@ class Crawler(BaseCrawler):
         return [parse(tr) for tr in rows]
 
 def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--profile", metavar="DIR", help="profile the crawl and write the profile to DIR")
+    options, args = parser.parse_args()
+
     FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
     logging.basicConfig(format=FORMAT, level=logging.INFO)
 
     crawler = Crawler("data/AE-2011-WB")
     # crawler.get_candidates(1)    
     #print crawler.download_affidavits(76)
-    crawler.get_data()
-    crawler.download_all()
+    with profile(options.profile, crawler.metrics):
+        with crawler.metrics.timer("metadata"):
+            crawler.ensure_data()
+        with crawler.metrics.timer("downloads"):
+            crawler.download_all()
+    
+    crawler.metrics.log_summary()
+    crawler.metrics.dump(os.path.join(crawler.root, "metrics.json"))
     
 class TestCrawler:
     def setup_method(self, method):
@@ -302,5 +312,68 @@ class TestCrawler:
         assert f("javascript:__doPostBack('ctl00$ContentPlaceHolder1$dlsSC$ctl01$lnkbtnDownload','')") == "SC-01"
         assert f("javascript:__doPostBack('ctl00$ContentPlaceHolder1$dlsSC$ctl01$lnkbtnDownload','')", {"SC": "Y"}) == "Y-01"
 
+    def test_download_affidavits(self):
+        import shutil
+        import tempfile
+        from replay import Recording, ReplayServer, start
+        from httpcache import cache_key
+        
+        url = "http://www.ceowb.in/ViewCandidateAffidavits.aspx?AffidavitsID=7"
+        link = '<a href="javascript:__doPostBack(\'ctl00$ContentPlaceHolder1$dls%s$ctl00$lnkbtnDownload\',\'\')">x</a>'
+        page = '<input type="hidden" name="__VIEWSTATE" value="state" />' + link % "Cr" + link % "SC"
+        
+        recording = Recording()
+        recording.add("GET", url, None, 200, [("Set-Cookie", "ASP.NET_SessionId=s1; path=/")], page)
+        for suffix in ["Cr", "SC"]:
+            data = {"__VIEWSTATE": "state"}
+            data['__EVENTTARGET'] = "ctl00$ContentPlaceHolder1$dls%s$ctl00$lnkbtnDownload" % suffix
+            data['__EVENTARGUMENT'] = ""
+            recording.add("POST", url, urllib.urlencode(data), 200, [], "pdf " + suffix)
+        
+        server = start(ReplayServer(("127.0.0.1", 0), recording))
+        os.environ["http_proxy"] = server.url
+        tmpdir = tempfile.mkdtemp()
+        try:
+            class UnthrottledCrawler(Crawler):
+                throttle_delay = 0
+            def run():
+                crawler = UnthrottledCrawler(os.path.join(tmpdir, "AE-2011-WB"))
+                crawler.download_affidavits(7)
+                return crawler
+            def network_requests(crawler):
+                return sum(s.requests - s.cache_hits for s in crawler.metrics.requests.values())
+            
+            crawler = run()
+            assert open(os.path.join(crawler.root, "files", "7-CR.pdf")).read() == "pdf Cr"
+            assert open(os.path.join(crawler.root, "files", "7-SC.pdf")).read() == "pdf SC"
+            assert [c.value for c in crawler.cookiejar] == ["s1"]
+            assert network_requests(crawler) == 3
+            
+            # the page comes from the cache and nothing is left to download
+            crawler = run()
+            assert network_requests(crawler) == 0
+            
+            # the postbacks are cached too
+            os.remove(os.path.join(crawler.root, "files", "7-SC.pdf"))
+            crawler = run()
+            assert open(os.path.join(crawler.root, "files", "7-SC.pdf")).read() == "pdf SC"
+            assert network_requests(crawler) == 0
+            
+            # the cached page has no session, it is fetched again before posting
+            os.remove(os.path.join(crawler.root, "files", "7-SC.pdf"))
+            # data is left from the loop above, it is the SC postback
+            hash = cache_key(url, urllib.urlencode(data))
+            for ext in [".headers", ".body", ".url", ".data"]:
+                os.remove(os.path.join(crawler.cache_dir, hash + ext))
+            crawler = run()
+            assert open(os.path.join(crawler.root, "files", "7-SC.pdf")).read() == "pdf SC"
+            assert [c.value for c in crawler.cookiejar] == ["s1"]
+            assert network_requests(crawler) == 2
+        finally:
+            del os.environ["http_proxy"]
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -2,16 +2,26 @@
 """
 import os
 import re
+import time
+import socket
+import httplib
 import urllib
 import urllib2
+import cookielib
 import simplejson
 import logging
 import functools
 import inspect
 import htmlentitydefs
+import StringIO
 
 from BeautifulSoup import BeautifulSoup
-from httpcache import CacheHandler, ThrottlingProcessor
+from httpcache import CacheHandler, CachedResponse, ThrottlingProcessor
+from blobstore import BlobStore, makedirs
+from metrics import Metrics, MetricsHandler
+from retry import RetryPolicy, CircuitBreaker, HostUnavailable
+from keepalive import ConnectionPool, KeepAliveHandler
+import datafile
 
 logger = logging.getLogger("base")
 
@@ -45,6 +55,8 @@ def disk_memoize(path):
     
     String formatting opeator can be used in the path, the actual path is constructed by formatting the specified path using the argument values.
     
+    Paths under files/ are saved in the blob store of the crawler, so that identical downloads are stored only once.
+
     Usage:
     
         @disk_memoize("data/c_%(number)s")
@@ -56,17 +68,34 @@ def disk_memoize(path):
         def g(self, *a, **kw):
             kwargs = to_kwargs(f, self, *a, **kw)
             filepath = os.path.join(self.root, path % kwargs)
-            disk = Disk()
-            content = disk.read(filepath)
+            if path.startswith("files/"):
+                disk = Disk(self.blobstore)
+            else:
+                disk = Disk()
+            with self.metrics.timer("disk.read"):
+                content = disk.read(filepath)
             if content:
                 return content
             else:
-                content = f(self, *a, **kw)
-                disk.write(filepath, content)
+                with self.metrics.labelled(f.__name__), self.metrics.timer(f.__name__):
+                    content = f(self, *a, **kw)
+                with self.metrics.timer("disk.write"):
+                    disk.write(filepath, content)
                 return content
+        # keep the undecorated function accessible, like functools.wraps does in python 3
+        g.__wrapped__ = f
         return g
     return decorator
 
+def replace(path):
+    """Removes the file at path, so that it can be written again.
+
+    Paths under files/ are links into the blob store. Writing to one in
+    place would change the blob and every other path linked to it.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
 class Disk:
     """Simple wrapper to read and write files in various formats.
     
@@ -74,16 +103,25 @@ class Disk:
 
     Other supported formats are:
         * json
+
+    When a blobstore is given, the content is added to the store and the path is linked to it.
     """
+    def __init__(self, blobstore=None):
+        self.blobstore = blobstore
+
     def write(self, path, content):
         if path.endswith(".json"):
             content = simplejson.dumps(content, indent=4)
+        
+        if self.blobstore:
+            logger.info("saving %s", path)
+            self.blobstore.save(path, content)
+            return
             
-        dirname = os.path.dirname(path)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        makedirs(os.path.dirname(path))
         
         logger.info("saving %s", path)
+        replace(path)
         with open(path, 'w') as f:
             f.write(content)
     
@@ -96,11 +134,88 @@ class Disk:
             else:
                 return content
             
+class PostbackSession:
+    """Postbacks of an ASP.NET page.
+    
+    The page is fetched once, through the HTTP cache, and its hidden form
+    fields like __VIEWSTATE and __EVENTVALIDATION are kept for all the
+    postbacks of the page. The cookies of the crawler, including the ASP.NET
+    session, are shared by all the requests.
+    
+    A page from the cache has no live session on the server. Before the first
+    postback that has to go to the server, the page is fetched again without
+    the cache, which starts a session and gives fresh form fields. Postbacks
+    that are all in the cache never touch the network.
+    """
+    def __init__(self, crawler, url):
+        self.crawler = crawler
+        self.url = url
+        self.live = False
+        self._soup = None
+        self._formdata = None
+        
+    @property
+    def soup(self):
+        if self._soup is None:
+            self.live = not self.crawler.is_cached(self.url)
+            self._soup = self.crawler.get_soup(self.url)
+        return self._soup
+        
+    @property
+    def formdata(self):
+        if self._formdata is None:
+            inputs = self.soup.findAll("input", {"type": "hidden"})
+            self._formdata = dict((i['name'], i.get('value', '')) for i in inputs)
+        return self._formdata
+        
+    def refresh(self):
+        """Fetches the page from the server, starting a new session.
+        """
+        self._soup = self.crawler.get_soup(self.url, _cache=False)
+        self._formdata = None
+        self.live = True
+        
+    def get_postback_links(self):
+        """Returns hrefs of all the javascript:__doPostBack links in the page.
+        """
+        return [a['href'] for a in self.soup.findAll("a") if a.get('href', '').startswith("javascript:__doPostBack")]
+        
+    def get_target(self, href):
+        """Returns the event target of a postback link.
+        
+            >>> PostbackSession(None, None).get_target("javascript:__doPostBack('ctl00$lnkbtnDownload','')")
+            'ctl00$lnkbtnDownload'
+        """
+        return href.split("'")[1]
+        
+    def postback(self, target, argument="", _cache=False):
+        """Posts the form of the page with the given event target and returns the response.
+        
+        The response is cached when _cache is True, see BaseCrawler.post.
+        """
+        data = self.get_postback_data(target, argument)
+        if not self.live and not (_cache and self.crawler.is_cached(self.url, data)):
+            self.refresh()
+            data = self.get_postback_data(target, argument)
+        return self.crawler.post(self.url, data, _cache=_cache)
+        
+    def get_postback_data(self, target, argument):
+        data = dict(self.formdata)
+        data['__EVENTTARGET'] = target
+        data['__EVENTARGUMENT'] = argument
+        return data
+            
 class BaseCrawler:
     """Base Crawler with useful utilities. 
     
     All the crawlers are extended from this class.
     """
+    # seconds to wait for the server before giving up on a request
+    timeout = 60
+    
+    # seconds to wait between requests to the same host
+    throttle_delay = 2
+    
     def __init__(self, root):
         """Creates the crawler.
         
@@ -116,23 +231,54 @@ class BaseCrawler:
         self.makedirs(self.files_dir)
         self.makedirs(self.data_dir)
         
+        # downloaded files are shared by all the crawlers under the same parent directory
+        self.blobstore = BlobStore(os.path.join(os.path.dirname(os.path.abspath(root)), "blobs"))
+        
+        self.metrics = Metrics()
+        
+        self.retry_policy = RetryPolicy()
+        self.circuit_breaker = CircuitBreaker()
+        # jobs put aside because their host was unavailable, see run_or_park
+        self.parked = []
+        
+        # connections are kept open and shared by all the openers
+        self.connection_pool = ConnectionPool(max_idle=2)
+        
+        # cookies are shared too, so that the server sees a single session
+        self.cookiejar = cookielib.CookieJar()
+        
         self.opener = urllib2.build_opener(
+            MetricsHandler(self.metrics),
             CacheHandler(self.cache_dir), 
-            ThrottlingProcessor(2))
+            urllib2.HTTPCookieProcessor(self.cookiejar),
+            ThrottlingProcessor(self.throttle_delay),
+            KeepAliveHandler(self.connection_pool))
 
         self.nocache_opener = urllib2.build_opener(
-            ThrottlingProcessor(2))
+            MetricsHandler(self.metrics),
+            urllib2.HTTPCookieProcessor(self.cookiejar),
+            ThrottlingProcessor(self.throttle_delay),
+            KeepAliveHandler(self.connection_pool))
             
         self.post_opener = urllib2.build_opener(
-            ThrottlingProcessor(2))
+            MetricsHandler(self.metrics),
+            urllib2.HTTPCookieProcessor(self.cookiejar),
+            ThrottlingProcessor(self.throttle_delay),
+            KeepAliveHandler(self.connection_pool))
+            
+        self.post_cache_opener = urllib2.build_opener(
+            MetricsHandler(self.metrics),
+            CacheHandler(self.cache_dir, cachePost=True), 
+            urllib2.HTTPCookieProcessor(self.cookiejar),
+            ThrottlingProcessor(self.throttle_delay),
+            KeepAliveHandler(self.connection_pool))
             
     def makedirs(self, path):
-        if not os.path.exists(path):
-            os.makedirs(path)
+        makedirs(path)
 
     def get(self, url, params=None, _cache=True):
         if params:
-            url += "?" + urllib.urlencode(params)
+            url += "?" + self.urlencode(params)
             
         if _cache:
             opener = self.opener
@@ -140,32 +286,171 @@ class BaseCrawler:
             opener = self.nocache_opener
         
         logger.info("GET %s", url)
-        return opener.open(url).read()
+        return self._open(opener, url)
         
-    def post(self, url, params):
-        if isinstance(params, dict):
-            params = urllib.urlencode(params)
+    def post(self, url, params, _cache=False):
+        """Posts params to url and returns the response body.
+        
+        The response is taken from the cache when _cache is True. That is
+        only for requests without side effects, like postbacks that return a
+        page or a file. ASP.NET state fields like __VIEWSTATE are not part of
+        the cache key.
+        """
+        if not isinstance(params, basestring):
+            params = self.urlencode(params)
+
+        if _cache:
+            opener = self.post_cache_opener
+        else:
+            opener = self.post_opener
 
         logger.info("POST %s", url)
-        return self.post_opener.open(url, params).read()
+        return self._open(opener, url, params)
         
-    def get_soup(self, url):
-        html = self.get(url)
-        return BeautifulSoup(html)
+    def is_cached(self, url, params=None):
+        """Tells whether the GET of url, or the POST of params to url when given, is in the cache.
+        """
+        if params is not None and not isinstance(params, basestring):
+            params = self.urlencode(params)
+        return CachedResponse.ExistsInCache(self.cache_dir, url, params)
+        
+    def urlencode(self, params):
+        """Encodes the params, sorting them when given as a dict so that the same params always give the same string.
+        """
+        if isinstance(params, dict):
+            params = sorted(params.items())
+        return urllib.urlencode(params)
+        
+    def _open(self, opener, url, data=None):
+        """Opens the url and returns the response body.
+        
+        Failed requests are retried as per the retry_policy. HostUnavailable is
+        raised without making the request when the host has been failing.
+        """
+        host = urllib2.Request(url).get_host()
+        if not self.circuit_breaker.allow(host):
+            raise HostUnavailable(host)
+        
+        attempt = 0
+        while True:
+            try:
+                content = opener.open(url, data, self.timeout).read()
+            except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+                # HTTP errors are already recorded by the MetricsHandler
+                if not isinstance(e, urllib2.HTTPError):
+                    self.metrics.record_error(host)
+                
+                if not self.retry_policy.is_retryable(e):
+                    # the host is responding fine, it is just an error for this url
+                    self.circuit_breaker.success(host)
+                    raise
+                
+                if attempt >= self.retry_policy.retries:
+                    self.circuit_breaker.failure(host)
+                    raise
+                
+                delay = self.retry_policy.get_delay(attempt)
+                logger.warning("%s failed (%s), retrying in %.1f seconds", url, e, delay)
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.circuit_breaker.success(host)
+                return content
+        
+    def get_soup(self, url, _cache=True):
+        with self.metrics.timer("fetch"):
+            html = self.get(url, _cache=_cache)
+        with self.metrics.timer("parse"):
+            return BeautifulSoup(html)
         
     def save(self, path, content):
         path = os.path.join(self.root, path)
+        replace(path)
         with open(path, "w") as f:
             f.write(content)
     
     def save_json(self, path, data):
         self.save(path, simplejson.dumps(data, indent=4))
     
+    def crawl_data(self):
+        """Crawls the election and returns it in data.json format.
+        
+        Every crawler must override this, it is called by ensure_data when
+        data.json is not there. The constituencies can be an iterator, they
+        are written to data.json as they are crawled.
+        """
+        raise NotImplementedError("%s must implement crawl_data" % self.__class__.__name__)
+        
+    def ensure_data(self):
+        """Crawls the election into data.json unless it is already there. Returns the path of data.json.
+        """
+        path = os.path.join(self.root, "data.json")
+        if not os.path.exists(path):
+            with self.metrics.labelled("crawl_data"), self.metrics.timer("crawl_data"):
+                datafile.write(path, self.crawl_data())
+        return path
+        
+    def get_data(self):
+        """Returns the data in data.json format.
+        
+        This loads the whole election, iter_constituencies is better when the constituencies are used one at a time.
+        """
+        return datafile.load(self.ensure_data())
+        
+    def iter_constituencies(self):
+        """Returns an iterator over the constituencies in data.json, reading one at a time.
+        """
+        return datafile.iter_constituencies(self.ensure_data())
+    
+    def crawl_metadata(self):
+        """Fetches all the metadata of the election, which is needed before downloading the files.
+        """
+        self.ensure_data()
+    
+    def get_downloads(self):
+        """Returns an iterator over (url, download) for all the files to download.
+        
+        download is a function without arguments that downloads the file from url.
+        """
+        return iter([])
+    
+    def run_or_park(self, f, *args, **kwargs):
+        """Calls f with the given arguments. If the host is unavailable or
+        the request failed after all the retries, the call is parked to be
+        tried again by run_parked. Other request errors are logged, so that
+        a single failing job doesn't stop the crawl.
+        """
+        try:
+            return f(*args, **kwargs)
+        except HostUnavailable, e:
+            logger.warning("%s, parking %s%s", e.reason, f.__name__, args)
+            self.parked.append((f, args, kwargs))
+        except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+            if self.retry_policy.is_retryable(e):
+                logger.warning("%s, parking %s%s", e, f.__name__, args)
+                self.parked.append((f, args, kwargs))
+            else:
+                logger.error("%s%s failed", f.__name__, args, exc_info=True)
+    
+    def run_parked(self):
+        """Gives the parked jobs another try, after all other jobs are done.
+        """
+        parked, self.parked = self.parked, []
+        if parked:
+            logger.info("trying %d parked jobs", len(parked))
+            self.circuit_breaker.reset()
+        for f, args, kwargs in parked:
+            self.run_or_park(f, *args, **kwargs)
+        for f, args, kwargs in self.parked:
+            logger.error("giving up on %s%s", f.__name__, args)
+    
     def download(self, url, method="GET", data=None, path=None):
         path = path or url.split("/")[-1]
         try:
             self._download(url, method=method, data=data, path=path)
-        except urllib2.HTTPError:
+        except HostUnavailable:
+            self.parked.append((self.download, (url,), dict(method=method, data=data, path=path)))
+        except (urllib2.URLError, socket.error, httplib.HTTPException):
             logger.error("failed to download %s", path, exc_info=True)
         
     @disk_memoize("files/%(path)s")
@@ -222,4 +507,66 @@ class BaseCrawler:
         url = a['href']
         if base_url:
             url = urllib.basejoin(base_url, url)
-        return title, url
\ No newline at end of file
+        return title, url
+
+class TestBaseCrawler:
+    class FailingOpener:
+        """Opener for a host that refuses connections until fail is set to False.
+        """
+        def __init__(self):
+            self.calls = 0
+            self.fail = True
+            self.error = urllib2.URLError(socket.error(111, "Connection refused"))
+
+        def open(self, url, data, timeout):
+            self.calls += 1
+            if self.fail:
+                raise self.error
+            return StringIO.StringIO("ok")
+
+    def setup_method(self, method):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.crawler = BaseCrawler(os.path.join(self.tmpdir, "AE-2011-XX"))
+        self.crawler.retry_policy = RetryPolicy(retries=2, backoff=0)
+        self.crawler.circuit_breaker = CircuitBreaker(failure_threshold=2)
+
+    def teardown_method(self, method):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_retry_and_park(self):
+        crawler = self.crawler
+        opener = self.FailingOpener()
+        url = "http://example.com/"
+
+        # one try and two retries
+        try:
+            crawler._open(opener, url)
+            assert False, "URLError not raised"
+        except urllib2.URLError:
+            pass
+        assert opener.calls == 3
+        assert crawler.circuit_breaker.failures["example.com"] == 1
+
+        # the second failure opens the circuit, the job is parked instead of failing the crawl
+        crawler.run_or_park(crawler._open, opener, url)
+        assert opener.calls == 6
+        assert "example.com" in crawler.circuit_breaker.opened_at
+
+        # parked without trying while the circuit is open
+        crawler.run_or_park(crawler._open, opener, url)
+        assert opener.calls == 6
+        assert len(crawler.parked) == 2
+
+        opener.fail = False
+        crawler.run_parked()
+        assert opener.calls == 8
+        assert crawler.parked == []
+
+    def test_not_retryable(self):
+        opener = self.FailingOpener()
+        opener.error = urllib2.HTTPError("http://example.com/", 404, "Not Found", {}, None)
+        assert self.crawler.run_or_park(self.crawler._open, opener, "http://example.com/") is None
+        assert opener.calls == 1
+        assert self.crawler.parked == []
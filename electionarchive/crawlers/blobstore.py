@@ -0,0 +1,221 @@
+"""Content-addressed store for downloaded files.
+
+Every file is stored once in the blob store, under a path derived from the
+SHA-256 of its content. The paths used by the crawlers (files/...) are
+hardlinks into the store, so the same document downloaded from many urls
+or for many elections takes the disk space only once. The blobs are
+read-only, as writing to one of the links would change the file for every
+path linked to it. A path is changed by replacing its link.
+
+To move the files of an existing crawl into the store:
+
+    python blobstore.py data/blobs data/AE-2011-KL/files data/AE-2011-PY/files
+"""
+import os
+import sys
+import stat
+import errno
+import shutil
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger("blobstore")
+
+def mkstemp(dir, suffix=""):
+    """Like tempfile.mkstemp, but the file gets the mode open() would have given it instead of 0600.
+
+    This is for files that are renamed into place and read by others later.
+    The umask is applied when the file is created, as for any other file.
+    """
+    while True:
+        path = os.path.join(dir, "tmp" + os.urandom(6).encode("hex") + suffix)
+        try:
+            return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666), path
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+def makedirs(dirname):
+    """Creates the directory and its parents unless it exists already.
+
+    Other threads may be creating the same directory at the same time, which is fine.
+    """
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def make_readonly(path):
+    os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~0222)
+
+class BlobStore:
+    """Directory of files named by the SHA-256 of their content.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def hash(self, content):
+        return hashlib.sha256(content).hexdigest()
+
+    def hash_file(self, path):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), ""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def blobpath(self, sha):
+        return os.path.join(self.root, sha[:2], sha)
+
+    def exists(self, sha):
+        return os.path.exists(self.blobpath(sha))
+
+    def put(self, content):
+        """Adds content to the store and returns its hash.
+
+        Nothing is written when the content is already present.
+        """
+        sha = self.hash(content)
+        if not self.exists(sha):
+            dirname = self._makedirs(self.blobpath(sha))
+            fd, tmp = mkstemp(dirname)
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            make_readonly(tmp)
+            os.rename(tmp, self.blobpath(sha))
+        else:
+            logger.info("blob %s already present", sha)
+        return sha
+
+    def link(self, sha, path):
+        """Makes path point to the blob with given hash.
+
+        A hardlink is used when possible, falling back to a copy when the
+        store and the path are on different filesystems.
+        """
+        blob = self.blobpath(sha)
+        if os.path.exists(path):
+            if os.path.samefile(blob, path):
+                return
+            os.remove(path)
+        self._makedirs(path)
+        try:
+            os.link(blob, path)
+        except OSError:
+            shutil.copyfile(blob, path)
+
+    def save(self, path, content):
+        """Stores the content and links path to it, replacing any file at path. Returns the hash.
+        """
+        sha = self.put(content)
+        self.link(sha, path)
+        return sha
+
+    def add_file(self, path):
+        """Moves an existing file into the store, leaving a link behind.
+        """
+        sha = self.hash_file(path)
+        blob = self.blobpath(sha)
+        if not os.path.exists(blob):
+            self._makedirs(blob)
+            try:
+                os.link(path, blob)
+            except OSError:
+                shutil.copyfile(path, blob)
+            make_readonly(blob)
+        self.link(sha, path)
+        return sha
+
+    def add_tree(self, dirname):
+        """Moves all the files under dirname into the store.
+        """
+        for dirpath, dirnames, filenames in os.walk(dirname):
+            for f in filenames:
+                path = os.path.join(dirpath, f)
+                logger.info("adding %s", path)
+                self.add_file(path)
+
+    def _makedirs(self, path):
+        dirname = os.path.dirname(path)
+        makedirs(dirname)
+        return dirname
+
+def main():
+    FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    store = BlobStore(sys.argv[1])
+    for dirname in sys.argv[2:]:
+        store.add_tree(dirname)
+
+class TestBlobStore:
+    def setup_method(self, method):
+        self.root = tempfile.mkdtemp()
+        self.store = BlobStore(os.path.join(self.root, "blobs"))
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.root)
+
+    def test_save(self):
+        a = os.path.join(self.root, "a", "x.pdf")
+        b = os.path.join(self.root, "b", "y.pdf")
+        sha = self.store.save(a, "hello")
+        assert self.store.save(b, "hello") == sha
+        assert open(b).read() == "hello"
+        assert os.path.samefile(a, b)
+        assert os.listdir(os.path.join(self.root, "blobs", sha[:2])) == [sha]
+        # readable by others as a file made by open would be, but not writable
+        open(os.path.join(self.root, "x"), "w").close()
+        assert os.stat(self.store.blobpath(sha)).st_mode == os.stat(os.path.join(self.root, "x")).st_mode & ~0222
+
+    def test_replace(self):
+        a = os.path.join(self.root, "a", "x.pdf")
+        b = os.path.join(self.root, "b", "y.pdf")
+        sha = self.store.save(a, "hello")
+        self.store.save(b, "hello")
+        self.store.save(a, "changed")
+        # a is linked to a new blob, b and the old blob are left alone
+        assert open(a).read() == "changed"
+        assert open(b).read() == "hello"
+        assert open(self.store.blobpath(sha)).read() == "hello"
+
+    def test_makedirs(self):
+        import threading
+        dirname = os.path.join(self.root, "a", "b")
+        errors = []
+        def f():
+            try:
+                makedirs(dirname)
+            except OSError, e:
+                errors.append(e)
+        # all the threads but one find the directory already made
+        threads = [threading.Thread(target=f) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        makedirs(dirname)
+        assert errors == []
+        assert os.path.isdir(dirname)
+
+        open(os.path.join(self.root, "f"), "w").close()
+        try:
+            makedirs(os.path.join(self.root, "f", "x"))
+            assert False, "OSError not raised"
+        except OSError:
+            pass
+
+    def test_add_tree(self):
+        files = os.path.join(self.root, "files")
+        os.makedirs(files)
+        for name in ["a.pdf", "b.pdf"]:
+            with open(os.path.join(files, name), "w") as f:
+                f.write("same")
+        self.store.add_tree(files)
+        assert os.path.samefile(os.path.join(files, "a.pdf"), os.path.join(files, "b.pdf"))
+        assert not os.stat(os.path.join(files, "a.pdf")).st_mode & 0222
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Streaming reader and writer for data.json.
+
+data.json has the election data with a list of constituencies, each with
+its candidates. Writing it with simplejson.dumps needs the whole election
+in memory, and so does reading it back. The writer here takes the
+constituencies from an iterator and writes each one as soon as it is
+available, on a line of its own:
+
+    {"_id": "AE-2011-KL", "state": "Kerala", ..., "constituencies": [
+    {"id": "1", "name": "...", "candidates": [...]},
+    {"id": "2", "name": "...", "candidates": [...]}
+    ]}
+
+The file is still valid JSON, so it can be loaded as a whole as before.
+iter_constituencies reads it one line at a time, keeping only a single
+constituency in memory. Files in other layouts, like the indented ones
+written before, are loaded completely.
+"""
+import os
+import logging
+import tempfile
+import simplejson
+
+from blobstore import makedirs, mkstemp
+
+logger = logging.getLogger("datafile")
+
+CONSTITUENCIES_START = '"constituencies": ['
+
+def write(path, data):
+    """Writes data to path. data['constituencies'] can be any iterable, it is consumed as it is written.
+
+    The file is written to a temporary file first, so that path is never left incomplete.
+    """
+    dirname = os.path.dirname(path) or "."
+    makedirs(dirname)
+
+    header = dict((k, v) for k, v in data.items() if k != "constituencies")
+    head = simplejson.dumps(header, sort_keys=True)[:-1]
+    if header:
+        head += ", "
+
+    fd, tmp = mkstemp(dirname)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(head + CONSTITUENCIES_START)
+            sep = "\n"
+            for cons in data.get("constituencies", []):
+                f.write(sep + simplejson.dumps(cons, sort_keys=True))
+                sep = ",\n"
+            f.write("\n]}\n")
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+    logger.info("saved %s", path)
+
+def _is_streamed(line):
+    return line.rstrip("\n").endswith(CONSTITUENCIES_START)
+
+def read_header(path):
+    """Returns the election data without the constituencies.
+    """
+    with open(path) as f:
+        line = f.readline()
+    if _is_streamed(line):
+        return simplejson.loads(line.rstrip("\n")[:-len(CONSTITUENCIES_START)].rstrip(", ") + "}")
+    data = load(path)
+    data.pop("constituencies", None)
+    return data
+
+def iter_constituencies(path):
+    """Returns an iterator over the constituencies in the data.json file at path.
+    """
+    with open(path) as f:
+        if not _is_streamed(f.readline()):
+            f.seek(0)
+            for cons in simplejson.loads(f.read()).get("constituencies", []):
+                yield cons
+            return
+
+        for line in f:
+            line = line.strip().rstrip(",")
+            if line == "]}":
+                return
+            if line:
+                yield simplejson.loads(line)
+
+def load(path):
+    """Loads the whole file.
+    """
+    with open(path) as f:
+        return simplejson.loads(f.read())
+
+class TestDataFile:
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "data.json")
+        self.data = {"_id": "AE-2011-XX", "state": "X", "constituencies": [
+            {"id": "1", "candidates": [{"name": "a, b\n]}"}]},
+            {"id": "2", "candidates": []}]}
+
+    def teardown_method(self, method):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        write(self.path, dict(self.data, constituencies=iter(self.data['constituencies'])))
+        assert load(self.path) == self.data
+        assert list(iter_constituencies(self.path)) == self.data['constituencies']
+        assert read_header(self.path) == {"_id": "AE-2011-XX", "state": "X"}
+        # the mode of a file made with open, not the 0600 of the temp file
+        open(os.path.join(self.tmpdir, "x"), "w").close()
+        assert os.stat(self.path).st_mode == os.stat(os.path.join(self.tmpdir, "x")).st_mode
+
+    def test_empty(self):
+        write(self.path, {"constituencies": []})
+        assert load(self.path) == {"constituencies": []}
+        assert list(iter_constituencies(self.path)) == []
+        assert read_header(self.path) == {}
+
+    def test_old_format(self):
+        with open(self.path, "w") as f:
+            f.write(simplejson.dumps(self.data, indent=4))
+        assert list(iter_constituencies(self.path)) == self.data['constituencies']
+        assert read_header(self.path) == {"_id": "AE-2011-XX", "state": "X"}
+
+    def test_failure(self):
+        def constituencies():
+            yield {"id": "1"}
+            raise ValueError("crawl failed")
+        try:
+            write(self.path, {"constituencies": constituencies()})
+        except ValueError:
+            pass
+        assert os.listdir(self.tmpdir) == []
@@ -9,9 +9,14 @@ import sys
 import time
 import re
 import os
+import urllib
 import urllib2
+import urlparse
 import httplib
+import cookielib
+import hashlib
 import unittest
+import threading
 import md5
 
 import StringIO
@@ -25,61 +30,128 @@ class ThrottlingProcessor(urllib2.BaseHandler):
 
     Causes subsequent requests to the same web server to be delayed
     a specific amount of seconds. The first request to the server
-    always gets made immediately"""
-    __shared_state = {}
+    always gets made immediately.
+
+    Requests to the same server from many threads are made one at a time,
+    each waiting for the delay after the previous one.
+
+    The times of the last requests are shared by all the instances, while
+    the delay is of each instance."""
+    # shared between object instances
+    lastRequestTime = {}
+    hostLocks = {}
+    __lock = threading.Lock()
+
     def __init__(self,throttleDelay=5):
         """The number of seconds to wait between subsequent requests"""
-        # Using the Borg design pattern to achieve shared state
-        # between object instances:
-        self.__dict__ = self.__shared_state
         self.throttleDelay = throttleDelay
-        if not hasattr(self,'lastRequestTime'):
-            self.lastRequestTime = {}
-        
+
     def default_open(self,request):
-        currentTime = time.time()
-        if ((request.host in self.lastRequestTime) and
-            (time.time() - self.lastRequestTime[request.host] < self.throttleDelay)):
-            self.throttleTime = (self.throttleDelay -
-                                 (currentTime - self.lastRequestTime[request.host]))
-            # print "ThrottlingProcessor: Sleeping for %s seconds" % self.throttleTime
-            time.sleep(self.throttleTime)
-        self.lastRequestTime[request.host] = currentTime
+        with self.__lock:
+            hostLock = self.hostLocks.setdefault(request.host, threading.Lock())
+        # held while sleeping, so that the other threads wait for their turn
+        with hostLock:
+            wait = 0
+            if request.host in self.lastRequestTime:
+                wait = self.throttleDelay - (time.time() - self.lastRequestTime[request.host])
+            if wait > 0:
+                time.sleep(wait)
+                request.throttle_wait = wait
+            self.lastRequestTime[request.host] = time.time()
 
         return None
 
     def http_response(self,request,response):
-        if hasattr(self,'throttleTime'):
-            response.info().addheader("x-throttling", "%s seconds" % self.throttleTime)
-            del(self.throttleTime)
+        if hasattr(request,'throttle_wait'):
+            response.info().addheader("x-throttling", "%s seconds" % request.throttle_wait)
         return response
 
+# form fields that change between page loads without changing the response, left out of the cache key
+VOLATILE_FIELDS = ["__VIEWSTATE", "__EVENTVALIDATION"]
+
+def canonical_query(query, exclude=[]):
+    """Returns the query string or form data with the parameters sorted and encoded the same way.
+
+        >>> canonical_query("b=2&a=x%20y&c", exclude=["c"])
+        'a=x+y&b=2'
+    """
+    params = [(k, v) for k, v in urlparse.parse_qsl(query, keep_blank_values=True) if k not in exclude]
+    return urllib.urlencode(sorted(params))
+
+def canonical_url(url):
+    """Returns the url with lower case scheme and host, without the default port
+    and the fragment, and with the query parameters sorted.
+
+        >>> canonical_url("HTTP://Example.COM:80/a?b=2&a=1#top")
+        'http://example.com/a?a=1&b=2'
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    scheme, netloc = scheme.lower(), netloc.lower()
+    if scheme == "http" and netloc.endswith(":80"):
+        netloc = netloc[:-len(":80")]
+    return urlparse.urlunsplit((scheme, netloc, path or "/", canonical_query(query), ""))
+
+def cache_key(url, data=None):
+    """Returns the name of the cache files of a request, without the extension.
+
+    Urls that differ only in the order or the encoding of the query
+    parameters get the same key. The key of a POST request includes its form
+    data, without the VOLATILE_FIELDS."""
+    key = canonical_url(url)
+    if data is not None:
+        key += "\n" + hashlib.sha1(canonical_query(data, VOLATILE_FIELDS)).hexdigest()
+    return md5.new(key).hexdigest()
+
+def legacy_cache_key(url):
+    """Returns the key used for GET requests before cache_key, md5 of the url as it is."""
+    return md5.new(url).hexdigest()
+
 class CacheHandler(urllib2.BaseHandler):
     """Stores responses in a persistant on-disk cache.
 
     If a subsequent GET request is made for the same URL, the stored
-    response is returned, saving time, resources and bandwith"""
-    def __init__(self,cacheLocation):
+    response is returned, saving time, resources and bandwith.
+
+    POST requests are cached too when cachePost is True, which is meant
+    for requests without side effects, like ASP.NET postbacks that only
+    return a page or a file."""
+    def __init__(self,cacheLocation,cachePost=False):
         """The location of the cache directory"""
         self.cacheLocation = cacheLocation
+        self.cachePost = cachePost
         if not os.path.exists(self.cacheLocation):
             os.mkdir(self.cacheLocation)
+
+    def IsCacheable(self, request):
+        return (request.get_method() == "GET" or
+                (self.cachePost and request.get_method() == "POST"))
+
+    def GetData(self, request):
+        """Returns the form data of POST requests and None for the others."""
+        if request.get_method() == "POST":
+            return request.get_data() or ""
             
     def default_open(self,request):
-        if ((request.get_method() == "GET") and 
-            (CachedResponse.ExistsInCache(self.cacheLocation, request.get_full_url()))):
+        if (self.IsCacheable(request) and
+            (CachedResponse.ExistsInCache(self.cacheLocation, request.get_full_url(), self.GetData(request)))):
             # print "CacheHandler: Returning CACHED response for %s" % request.get_full_url()
-            return CachedResponse(self.cacheLocation, request.get_full_url(), setCacheHeader=True)	
+            response = CachedResponse(self.cacheLocation, request.get_full_url(), setCacheHeader=True, data=self.GetData(request))
+            # the cookies were set for the session of the cached response, which is long gone
+            del response.headers["Set-Cookie"]
+            return response
         else:
             return None # let the next handler try to handle the request
 
     def http_response(self, request, response):
-        if request.get_method() == "GET":
+        # error responses are not cached, as they would be returned as 200 OK from the cache
+        if self.IsCacheable(request) and response.code == 200:
+            data = self.GetData(request)
             if 'x-cache' not in response.info():
-                CachedResponse.StoreInCache(self.cacheLocation, request.get_full_url(), response)
-                return CachedResponse(self.cacheLocation, request.get_full_url(), setCacheHeader=False)
+                CachedResponse.StoreInCache(self.cacheLocation, request.get_full_url(), response, data)
+                return CachedResponse(self.cacheLocation, request.get_full_url(), setCacheHeader=False, data=data)
             else:
-                return CachedResponse(self.cacheLocation, request.get_full_url(), setCacheHeader=True)
+                # served by default_open
+                return response
         else:
             return response
     
@@ -89,26 +161,48 @@ class CachedResponse(StringIO.StringIO):
     To determine wheter a response is cached or coming directly from
     the network, check the x-cache header rather than the object type."""
     
-    def ExistsInCache(cacheLocation, url):
-        hash = md5.new(url).hexdigest()
-        return (os.path.exists(cacheLocation + "/" + hash + ".headers") and 
-                os.path.exists(cacheLocation + "/" + hash + ".body"))
+    def FindInCache(cacheLocation, url, data=None):
+        """Returns the key of the cache entry of the request or None.
+
+        GET requests cached with the legacy_cache_key are found too."""
+        keys = [cache_key(url, data)]
+        if data is None:
+            keys.append(legacy_cache_key(url))
+        for hash in keys:
+            if (os.path.exists(cacheLocation + "/" + hash + ".headers") and 
+                os.path.exists(cacheLocation + "/" + hash + ".body")):
+                return hash
+    FindInCache = staticmethod(FindInCache)
+
+    def ExistsInCache(cacheLocation, url, data=None):
+        return CachedResponse.FindInCache(cacheLocation, url, data) is not None
     ExistsInCache = staticmethod(ExistsInCache)
 
-    def StoreInCache(cacheLocation, url, response):
-        hash = md5.new(url).hexdigest()
+    def StoreInCache(cacheLocation, url, response, data=None):
+        CachedResponse.StoreContent(cacheLocation, url, str(response.info()), response.read(), data)
+    StoreInCache = staticmethod(StoreInCache)
+
+    def StoreContent(cacheLocation, url, headers, body, data=None):
+        hash = cache_key(url, data)
         f = open(cacheLocation + "/" + hash + ".headers", "w")
-        headers = str(response.info())
         f.write(headers)
         f.close()
         f = open(cacheLocation + "/" + hash + ".body", "w")
-        f.write(response.read())
+        f.write(body)
         f.close()
-    StoreInCache = staticmethod(StoreInCache)
+        # the url can't be found from the hash, it is needed to export the cache
+        f = open(cacheLocation + "/" + hash + ".url", "w")
+        f.write(url)
+        f.close()
+        if data is not None:
+            f = open(cacheLocation + "/" + hash + ".data", "w")
+            f.write(data)
+            f.close()
+    StoreContent = staticmethod(StoreContent)
     
-    def __init__(self, cacheLocation,url,setCacheHeader=True):
+    def __init__(self, cacheLocation,url,setCacheHeader=True,data=None):
         self.cacheLocation = cacheLocation
-        hash = md5.new(url).hexdigest()
+        hash = CachedResponse.FindInCache(cacheLocation, url, data) or cache_key(url, data)
         StringIO.StringIO.__init__(self, file(self.cacheLocation + "/" + hash+".body").read())
         self.url     = url
         self.code    = 200
@@ -125,6 +219,12 @@ class CachedResponse(StringIO.StringIO):
 
 class Tests(unittest.TestCase):
     def setUp(self):
+        # www.python.org is served by a local replay server, so that the tests don't need the network
+        from replay import Recording, ReplayServer, start
+        recording = Recording()
+        recording.add("GET", "http://www.python.org/", None, 200, [("Content-Type", "text/html")], "<html></html>")
+        self.server = start(ReplayServer(("127.0.0.1", 0), recording))
+        os.environ["http_proxy"] = self.server.url
         # Clearing cache
         if os.path.exists(".urllib2cache"):
             for f in os.listdir(".urllib2cache"):
@@ -133,6 +233,11 @@ class Tests(unittest.TestCase):
         t = ThrottlingProcessor()
         t.lastRequestTime.clear()
 
+    def tearDown(self):
+        del os.environ["http_proxy"]
+        self.server.shutdown()
+        self.server.server_close()
+
     def testCache(self):
         opener = urllib2.build_opener(CacheHandler(".urllib2cache"))
         resp = opener.open("http://www.python.org/")
@@ -140,6 +245,47 @@ class Tests(unittest.TestCase):
         resp = opener.open("http://www.python.org/")
         self.assert_('x-cache' in resp.info())
         
+    def testCacheCookies(self):
+        self.server.recording.add("GET", "http://www.python.org/cookie", None, 200, [("Set-Cookie", "s=1; path=/")], "")
+        cookiejar = cookielib.CookieJar()
+        opener = urllib2.build_opener(CacheHandler(".urllib2cache"), urllib2.HTTPCookieProcessor(cookiejar))
+        opener.open("http://www.python.org/cookie")
+        self.assertEqual([c.value for c in cookiejar], ["1"])
+        cookiejar.clear()
+        resp = opener.open("http://www.python.org/cookie")
+        self.assert_('x-cache' in resp.info())
+        self.assertEqual(list(cookiejar), [])
+
+    def testCacheKey(self):
+        self.assertEqual(cache_key("http://example.com/?a=1&b=x%20y"), cache_key("http://EXAMPLE.com:80/?b=x+y&a=1"))
+        self.assertEqual(cache_key("http://example.com/", "a=1&__VIEWSTATE=x"), cache_key("http://example.com/", "__VIEWSTATE=y&a=1"))
+        self.assertNotEqual(cache_key("http://example.com/", "a=1"), cache_key("http://example.com/", "a=2"))
+        self.assertNotEqual(cache_key("http://example.com/", ""), cache_key("http://example.com/"))
+
+    def testLegacyCache(self):
+        opener = urllib2.build_opener(CacheHandler(".urllib2cache"))
+        # entries saved before cache_key are named by the md5 of the url
+        hash = legacy_cache_key("http://www.python.org/")
+        open(".urllib2cache/%s.headers" % hash, "w").write("")
+        open(".urllib2cache/%s.body" % hash, "w").write("old")
+        resp = opener.open("http://www.python.org/")
+        self.assert_('x-cache' in resp.info())
+        self.assertEqual(resp.read(), "old")
+
+    def testCachePost(self):
+        self.server.recording.add("POST", "http://www.python.org/", "a=1", 200, [], "posted")
+        opener = urllib2.build_opener(CacheHandler(".urllib2cache"))
+        resp = opener.open("http://www.python.org/", "a=1")
+        self.assert_('x-cache' not in resp.info())
+        resp = opener.open("http://www.python.org/", "a=1")
+        self.assert_('x-cache' not in resp.info())
+
+        opener = urllib2.build_opener(CacheHandler(".urllib2cache", cachePost=True))
+        opener.open("http://www.python.org/", "a=1&__VIEWSTATE=x")
+        resp = opener.open("http://www.python.org/", "__VIEWSTATE=y&a=1")
+        self.assert_('x-cache' in resp.info())
+        self.assertEqual(resp.read(), "posted")
+
     def testThrottle(self):
         opener = urllib2.build_opener(ThrottlingProcessor(5))
         resp = opener.open("http://www.python.org/")
@@ -147,6 +293,28 @@ class Tests(unittest.TestCase):
         resp = opener.open("http://www.python.org/")
         self.assert_('x-throttling' in resp.info())
 
+    def testThrottleThreads(self):
+        class Request:
+            host = "throttle.example.com"
+        throttle = ThrottlingProcessor(0.2)
+        times = []
+        def open():
+            throttle.default_open(Request())
+            times.append(time.time())
+        threads = [threading.Thread(target=open) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        times.sort()
+        self.assert_(times[1] - times[0] >= 0.19 and times[2] - times[1] >= 0.19, times)
+
+    def testThrottleDelayPerInstance(self):
+        slow, fast = ThrottlingProcessor(5), ThrottlingProcessor(0)
+        self.assertEqual(slow.throttleDelay, 5)
+        self.assertEqual(fast.throttleDelay, 0)
+        self.assert_(slow.lastRequestTime is fast.lastRequestTime)
+
     def testCombined(self):
         opener = urllib2.build_opener(CacheHandler(".urllib2cache"), ThrottlingProcessor(10))
         resp = opener.open("http://www.python.org/")
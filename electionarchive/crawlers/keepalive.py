@@ -0,0 +1,168 @@
+"""HTTP/1.1 keep-alive for urllib2.
+
+urllib2 opens a new connection for every request. KeepAliveHandler keeps
+the connections open after the response is read and reuses them for the
+next request to the same host. The idle connections are kept in a
+ConnectionPool, which can be shared by many openers.
+"""
+import socket
+import urllib
+import urllib2
+import httplib
+import logging
+import StringIO
+import threading
+import BaseHTTPServer
+import SocketServer
+
+logger = logging.getLogger("keepalive")
+
+class ConnectionPool:
+    """Idle HTTP connections, keyed by host.
+
+    At most max_idle connections are kept for each host, the extra ones are closed.
+    """
+    def __init__(self, max_idle=2):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        """Returns an idle connection to the host or None.
+        """
+        with self.lock:
+            connections = self.idle.get(host)
+            return connections and connections.pop() or None
+
+    def put(self, host, conn):
+        with self.lock:
+            connections = self.idle.setdefault(host, [])
+            if len(connections) < self.max_idle:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+            self.idle.clear()
+
+class KeepAliveHandler(urllib2.HTTPHandler):
+    """HTTP handler that reuses connections from a ConnectionPool.
+
+    The response body is read completely before the connection is given
+    back to the pool, so the returned response is in memory.
+    """
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        conn = self.pool.get(host)
+        try:
+            if conn:
+                try:
+                    response = self._send(conn, req)
+                except (socket.error, httplib.HTTPException):
+                    # the server may have closed the idle connection, try again with a new one
+                    conn.close()
+                    conn = None
+            if conn is None:
+                conn = httplib.HTTPConnection(host, timeout=req.timeout)
+                response = self._send(conn, req)
+            body = response.read()
+        except socket.error, err:
+            conn.close()
+            raise urllib2.URLError(err)
+        except httplib.HTTPException:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.put(host, conn)
+
+        resp = urllib.addinfourl(StringIO.StringIO(body), response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def _send(self, conn, req):
+        timeout = req.timeout
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers["Connection"] = "keep-alive"
+        headers = dict((name.title(), value) for name, value in headers.items())
+
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        return conn.getresponse()
+
+class TestKeepAlive:
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        connections = []
+
+        def setup(self):
+            self.connections.append(self.client_address)
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "5")
+            self.end_headers()
+            self.wfile.write("hello")
+
+        def do_POST(self):
+            data = self.rfile.read(int(self.headers['Content-Length']))
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *a):
+            pass
+
+    def setup_method(self, method):
+        self.Handler.connections = []
+        self.server = SocketServer.ThreadingTCPServer(("127.0.0.1", 0), self.Handler)
+        self.server.daemon_threads = True
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+    def teardown_method(self, method):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuse(self):
+        pool = ConnectionPool()
+        opener1 = urllib2.build_opener(KeepAliveHandler(pool))
+        opener2 = urllib2.build_opener(KeepAliveHandler(pool))
+
+        assert opener1.open(self.url).read() == "hello"
+        assert opener2.open(self.url + "x").read() == "hello"
+        assert opener1.open(self.url, "a=1").read() == "a=1"
+        assert len(self.Handler.connections) == 1
+        pool.close()
+
+    def test_max_idle(self):
+        pool = ConnectionPool(max_idle=1)
+        a, b = httplib.HTTPConnection("x"), httplib.HTTPConnection("x")
+        pool.put("x", a)
+        pool.put("x", b)
+        assert pool.get("x") is a
+        assert pool.get("x") is None
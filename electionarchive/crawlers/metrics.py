@@ -0,0 +1,285 @@
+"""Metrics of the HTTP requests and the stages of a crawl.
+
+MetricsHandler is added to the urllib2 opener to record, per host and per
+crawler method, the number of requests, latency, bytes, cache hits and
+misses, time spent waiting in ThrottlingProcessor and errors. Timers record
+the time spent in stages like fetching and parsing pages.
+
+The metrics can be logged as a summary or exported as JSON or as a
+Prometheus text file.
+"""
+import time
+import shutil
+import tempfile
+import urllib
+import urllib2
+import httplib
+import logging
+import StringIO
+import threading
+import contextlib
+import simplejson
+
+from httpcache import CacheHandler
+
+logger = logging.getLogger("metrics")
+
+class Histogram:
+    """Histogram with fixed buckets, in the style of Prometheus.
+    """
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.BUCKETS) and value > self.BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Returns list of (upper bound, cumulative count) including +Inf.
+        """
+        total = 0
+        result = []
+        for le, c in zip(self.BUCKETS + ["+Inf"], self.counts):
+            total += c
+            result.append((le, total))
+        return result
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "buckets": self.cumulative()}
+
+class RequestStats:
+    def __init__(self):
+        self.requests = 0
+        self.latency = Histogram()
+        self.bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.throttle_wait = 0.0
+        self.errors = 0
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "latency": self.latency.to_dict(),
+            "bytes": self.bytes,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "throttle_wait": self.throttle_wait,
+            "errors": self.errors,
+        }
+
+class Metrics:
+    """Collects request stats keyed by (host, method) and stage timers.
+
+    The method is the crawler method being run, set using labelled.
+    """
+    def __init__(self):
+        self.requests = {}
+        self.timers = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def label(self):
+        labels = getattr(self._local, "labels", None)
+        return labels and labels[-1] or "-"
+
+    @contextlib.contextmanager
+    def labelled(self, label):
+        """Attributes the requests made in the block to label.
+        """
+        if not hasattr(self._local, "labels"):
+            self._local.labels = []
+        self._local.labels.append(label)
+        try:
+            yield
+        finally:
+            self._local.labels.pop()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Records the time spent in the block under the stage name.
+        """
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - t0)
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.timers.setdefault(name, Histogram()).observe(seconds)
+
+    def get_stats(self, host):
+        key = (host, self.label)
+        if key not in self.requests:
+            self.requests[key] = RequestStats()
+        return self.requests[key]
+
+    def record_request(self, host, latency, bytes=0, cache_hit=False, throttle_wait=0.0, error=False):
+        with self._lock:
+            stats = self.get_stats(host)
+            stats.requests += 1
+            stats.latency.observe(latency)
+            stats.bytes += bytes
+            if cache_hit:
+                stats.cache_hits += 1
+            else:
+                stats.cache_misses += 1
+            stats.throttle_wait += throttle_wait
+            if error:
+                stats.errors += 1
+
+    def record_error(self, host):
+        """Records a failed request that didn't get any response.
+        """
+        with self._lock:
+            self.get_stats(host).errors += 1
+
+    def to_dict(self):
+        return {
+            "requests": [dict(stats.to_dict(), host=host, method=method)
+                         for (host, method), stats in sorted(self.requests.items())],
+            "timers": dict((name, h.to_dict()) for name, h in self.timers.items()),
+        }
+
+    def to_prometheus(self):
+        lines = []
+        def add(name, type, help, samples):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type))
+            for labels, value in samples:
+                labels = ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+                lines.append("%s{%s} %s" % (name, labels, value))
+
+        def histogram_samples(h, labels):
+            for le, count in h.cumulative():
+                yield ("bucket", labels + [("le", le)], count)
+            yield ("sum", labels, h.sum)
+            yield ("count", labels, h.count)
+
+        items = sorted(self.requests.items())
+        for name, attr, help in [
+                ("crawler_requests_total", "requests", "Number of HTTP requests."),
+                ("crawler_response_bytes_total", "bytes", "Bytes received."),
+                ("crawler_cache_hits_total", "cache_hits", "Requests served from the cache."),
+                ("crawler_cache_misses_total", "cache_misses", "Requests not found in the cache."),
+                ("crawler_throttle_wait_seconds_total", "throttle_wait", "Time spent waiting by the throttler."),
+                ("crawler_errors_total", "errors", "Failed requests.")]:
+            add(name, "counter", help, [([("host", host), ("method", method)], getattr(stats, attr))
+                                        for (host, method), stats in items])
+
+        for name, help, histograms in [
+                ("crawler_request_duration_seconds", "Time taken for the response headers.",
+                 [([("host", host), ("method", method)], stats.latency) for (host, method), stats in items]),
+                ("crawler_stage_duration_seconds", "Time spent in each stage.",
+                 [([("stage", name)], h) for name, h in sorted(self.timers.items())])]:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s histogram" % name)
+            for labels, h in histograms:
+                for suffix, l, value in histogram_samples(h, labels):
+                    l = ",".join('%s="%s"' % (k, v) for k, v in l)
+                    lines.append("%s_%s{%s} %s" % (name, suffix, l, value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Returns a human readable summary as a list of lines.
+        """
+        lines = []
+        for (host, method), s in sorted(self.requests.items()):
+            avg = s.latency.count and s.latency.sum / s.latency.count or 0
+            lines.append("%s %s: %d requests, %d cache hits, %d errors, %d bytes, avg %.3fs, throttled %.1fs" % (
+                host, method, s.requests, s.cache_hits, s.errors, s.bytes, avg, s.throttle_wait))
+        for name, h in sorted(self.timers.items()):
+            lines.append("%s: %d calls, %.3fs total" % (name, h.count, h.sum))
+        return lines
+
+    def log_summary(self):
+        for line in self.summary():
+            logger.info(line)
+
+    def dump(self, path):
+        """Writes the metrics to path, in Prometheus text format if path ends with .prom and as JSON otherwise.
+        """
+        if path.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = simplejson.dumps(self.to_dict(), indent=4)
+        with open(path, "w") as f:
+            f.write(content)
+
+def get_host(request):
+    """Returns the host of the request url, which is not the same as request.get_host() when a proxy is used.
+    """
+    return urllib.splithost(urllib.splittype(request.get_full_url())[1])[0]
+
+class MetricsHandler(urllib2.BaseHandler):
+    """urllib2 handler that records every response in Metrics.
+
+    This runs before the other handlers, so the recorded latency includes
+    the time spent in the cache, from which the throttle wait is subtracted.
+    """
+    handler_order = 100
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def default_open(self, request):
+        request.start_time = time.time()
+        return None
+
+    def http_response(self, request, response):
+        throttle_wait = getattr(request, "throttle_wait", 0.0)
+        latency = time.time() - request.start_time - throttle_wait
+        info = response.info()
+        self.metrics.record_request(
+            get_host(request),
+            latency,
+            bytes=int(info.get("content-length") or 0),
+            cache_hit='x-cache' in info,
+            throttle_wait=throttle_wait,
+            error=response.code >= 400)
+        return response
+
+    https_response = http_response
+
+class TestMetrics:
+    class StubHandler(urllib2.BaseHandler):
+        handler_order = 400
+        def http_open(self, request):
+            headers = httplib.HTTPMessage(StringIO.StringIO("Content-Length: 5\r\n"))
+            response = urllib.addinfourl(StringIO.StringIO("hello"), headers, request.get_full_url())
+            response.code, response.msg = 200, "OK"
+            return response
+
+    def test_requests(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            metrics = Metrics()
+            opener = urllib2.build_opener(MetricsHandler(metrics), CacheHandler(cache_dir), self.StubHandler())
+            with metrics.labelled("get_foo"):
+                opener.open("http://example.com/a").read()
+                opener.open("http://example.com/a").read()
+        finally:
+            shutil.rmtree(cache_dir)
+
+        stats = metrics.requests["example.com", "get_foo"]
+        assert stats.requests == 2
+        assert stats.cache_hits == 1
+        assert stats.bytes == 10
+        assert 'crawler_requests_total{host="example.com",method="get_foo"} 2' in metrics.to_prometheus()
+
+    def test_timer(self):
+        metrics = Metrics()
+        with metrics.timer("parse"):
+            pass
+        assert metrics.timers["parse"].count == 1
+        assert metrics.summary()[-1].startswith("parse: 1 calls")
@@ -0,0 +1,140 @@
+"""Profiling of crawler and webapp runs.
+
+The profiler collects a cProfile profile of the main thread and samples the
+stacks of all the threads at a fixed interval. When saved, the output
+directory gets:
+
+    profile.prof - cProfile stats, to be read with pstats or snakeviz
+    stacks.txt - sampled stacks in the collapsed format used by flamegraph.pl and speedscope
+    stages.json - wall-clock time spent in each stage, from the metrics timers
+"""
+import os
+import sys
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+import simplejson
+
+logger = logging.getLogger("profiler")
+
+class Profiler:
+    def __init__(self, outdir, interval=0.005):
+        self.outdir = outdir
+        self.interval = interval
+        self.profile = cProfile.Profile()
+        self.stats = None
+        self.stacks = {}
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._sample, name="profiler")
+        self._sampler.daemon = True
+        self._sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self._stopped.set()
+        self._sampler.join()
+        self.add_stats(self.profile)
+
+    def add_stats(self, profile):
+        """Adds the stats of a cProfile.Profile, like the one of a request in another thread.
+        """
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != me:
+                    stack = self._get_stack(frame)
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def _get_stack(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def save(self, metrics=None):
+        if not os.path.exists(self.outdir):
+            os.makedirs(self.outdir)
+
+        if self.stats is not None:
+            self.stats.dump_stats(os.path.join(self.outdir, "profile.prof"))
+
+        with open(os.path.join(self.outdir, "stacks.txt"), "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+
+        if metrics is not None:
+            stages = dict((name, {"count": h.count, "seconds": h.sum}) for name, h in metrics.timers.items())
+            with open(os.path.join(self.outdir, "stages.json"), "w") as f:
+                f.write(simplejson.dumps(stages, indent=4, sort_keys=True))
+        logger.info("saved profile to %s", self.outdir)
+
+@contextlib.contextmanager
+def profile(outdir, metrics=None):
+    """Profiles the block and saves the profile to outdir. Nothing is done when outdir is None.
+    """
+    if outdir is None:
+        yield None
+        return
+
+    profiler = Profiler(outdir)
+    profiler.start()
+    t0 = time.time()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        logger.info("finished in %.1f seconds", time.time() - t0)
+        profiler.save(metrics)
+
+def pop_profile_option(argv):
+    """Removes --profile DIR from argv and returns DIR, or None when the option is not there.
+
+    This is for programs like the webapp which leave the other arguments to someone else.
+    """
+    if "--profile" in argv:
+        i = argv.index("--profile")
+        outdir = argv[i+1]
+        del argv[i:i+2]
+        return outdir
+
+class TestProfiler:
+    def test_profile(self):
+        import shutil
+        import tempfile
+        from metrics import Metrics
+
+        outdir = tempfile.mkdtemp()
+        metrics = Metrics()
+        try:
+            with profile(outdir, metrics):
+                with metrics.timer("work"):
+                    time.sleep(0.05)
+            assert sorted(os.listdir(outdir)) == ["profile.prof", "stacks.txt", "stages.json"]
+            assert "test_profile" in open(os.path.join(outdir, "stacks.txt")).read()
+            assert simplejson.loads(open(os.path.join(outdir, "stages.json")).read())["work"]["count"] == 1
+        finally:
+            shutil.rmtree(outdir)
+
+    def test_pop_profile_option(self):
+        argv = ["webapp.py", "--profile", "/tmp/p", "8080"]
+        assert pop_profile_option(argv) == "/tmp/p"
+        assert argv == ["webapp.py", "8080"]
+        assert pop_profile_option(argv) is None
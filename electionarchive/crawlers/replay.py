@@ -0,0 +1,429 @@
+"""Record and replay server for running the crawlers without the network.
+
+The server is an HTTP proxy. In record mode it forwards the requests to the
+real sites and writes the requests and responses to a WARC file. In replay
+mode it serves the responses from WARC files, recorded by it or exported
+from a crawler cache with warc.py. Requests are matched by method, url and,
+for POST requests like the ASP.NET postbacks, the form data. Requests that
+were not recorded get a 404.
+
+Latency, limited bandwidth, errors and per-host rate limits can be added to
+the replayed responses, to see how the crawlers deal with slow and failing
+sites. The run command crawls through the server with all the crawlers, in
+the way scheduler.py does, and reports the throughput.
+
+Usage:
+
+    python replay.py record [--port 8080] recorded.warc.gz
+    python replay.py serve [options] recorded.warc.gz [...]
+    python replay.py run [options] recorded.warc.gz [...]
+
+The crawlers use the server when the http_proxy environment variable points to it:
+
+    http_proxy=http://127.0.0.1:8080 python AE_2011_KL.py
+"""
+import os
+import gzip
+import time
+import random
+import shutil
+import socket
+import urllib2
+import httplib
+import logging
+import optparse
+import tempfile
+import threading
+import simplejson
+import BaseHTTPServer
+import SocketServer
+
+import base
+import scheduler
+from retry import RetryPolicy
+from httpcache import ThrottlingProcessor, cache_key
+from warc import WARCWriter, read_records, read_requests, write_response, parse_http_response, get_selector, SKIP_HEADERS
+
+logger = logging.getLogger("replay")
+
+# headers of the client connection to the proxy, not to be sent to the site
+HOP_HEADERS = ["connection", "keep-alive", "proxy-connection", "content-length", "accept-encoding"]
+
+def parse_headers(headers):
+    """Returns list of (name, value) from headers in the HTTP format.
+    """
+    return [tuple(v.strip() for v in line.split(":", 1)) for line in headers.splitlines() if ":" in line]
+
+class Recording:
+    """Recorded responses, keyed by method and the cache key of url and data.
+
+    Like in the HTTP cache, the order of the parameters and the ASP.NET state
+    fields in the form data don't matter when matching requests.
+    """
+    def __init__(self):
+        self.responses = {}
+
+    def get_key(self, method, url, data):
+        if method == "POST":
+            return method, cache_key(url, data or "")
+        else:
+            return method, cache_key(url)
+
+    def add(self, method, url, data, status, headers, body):
+        self.responses[self.get_key(method, url, data)] = (status, headers, body)
+
+    def get(self, method, url, data):
+        return self.responses.get(self.get_key(method, url, data))
+
+    def load(self, warcpath):
+        """Adds the responses in a WARC file.
+
+        The resource records of files with a url are served for GET requests of that url,
+        unless there is a response record for it.
+        """
+        requests = read_requests(warcpath)
+        responses = []
+        f = gzip.open(warcpath)
+        try:
+            for headers, block in read_records(f):
+                type = headers.get("warc-type")
+                url = headers.get("warc-target-uri")
+                if type == "response" and headers.get("content-type", "").startswith("application/http"):
+                    method, data = requests.get(headers["warc-record-id"], ("GET", None))
+                    responses.append((method, url, data, parse_http_response(block)))
+                elif type == "resource" and url:
+                    self.add("GET", url, None, 200, [("Content-Type", headers.get("content-type", "application/octet-stream"))], block)
+        finally:
+            f.close()
+
+        for method, url, data, (status, headers, body) in responses:
+            self.add(method, url, data, status, parse_headers(headers), body)
+        logger.info("loaded %d responses from %s", len(responses), warcpath)
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """The proxy server. Responses are recorded to writer when it is given and replayed from recording otherwise.
+
+    latency is the seconds to wait before responding, bandwidth the bytes
+    sent per second, error_rate the fraction of requests that fail with a
+    503 or a dropped connection and rate_limit the requests per second
+    allowed for each host, after which the requests get a 429.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, recording=None, writer=None,
+                 latency=0, bandwidth=None, error_rate=0, rate_limit=None, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReplayHandler)
+        self.recording = recording or Recording()
+        self.writer = writer
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.last_request = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+    def is_rate_limited(self, host):
+        with self.lock:
+            now = time.time()
+            last = self.last_request.get(host)
+            if self.rate_limit and last is not None and now - last < 1.0 / self.rate_limit:
+                return True
+            self.last_request[host] = now
+            return False
+
+    def get_error(self):
+        """Returns the error to inject, "status" or "reset", or None.
+        """
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                return self.random.choice(["status", "reset"])
+
+    def record(self, method, url, request_headers, data, status, reason, headers, body):
+        headers = "".join("%s: %s\r\n" % (name, value) for name, value in headers)
+        with self.lock:
+            write_response(self.writer, method, url, headers, body, data, status, reason, request_headers)
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.handle_request()
+
+    do_POST = do_HEAD = do_GET
+
+    def get_url(self):
+        # proxy requests have the full url, the others only the path
+        if self.path.startswith("http://"):
+            return self.path
+        return "http://%s%s" % (self.headers.get("host"), self.path)
+
+    def handle_request(self):
+        method, url = self.command, self.get_url()
+        length = int(self.headers.get("content-length") or 0)
+        data = length and self.rfile.read(length) or None
+
+        if self.server.writer:
+            return self.forward(method, url, data)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.is_rate_limited(urllib2.Request(url).get_host()):
+            return self.send(429, [("Retry-After", "1")], "rate limited\n")
+
+        error = self.server.get_error()
+        if error == "reset":
+            self.close_connection = 1
+            return
+        elif error == "status":
+            return self.send(503, [], "injected error\n")
+
+        response = self.server.recording.get(method, url, data)
+        if response is None:
+            logger.warning("%s %s was not recorded", method, url)
+            return self.send(404, [], "not recorded\n")
+        self.send(*response)
+
+    def forward(self, method, url, data):
+        headers = [(name.title(), value) for name, value in self.headers.items() if name not in HOP_HEADERS]
+        host = urllib2.Request(url).get_host()
+        conn = httplib.HTTPConnection(host, timeout=60)
+        try:
+            conn.request(method, get_selector(url), data, dict(headers))
+            response = conn.getresponse()
+            body = response.read()
+        except (socket.error, httplib.HTTPException), e:
+            logger.error("%s %s failed: %s", method, url, e)
+            return self.send(502, [], "%s\n" % e)
+        finally:
+            conn.close()
+
+        response_headers = [(name.title(), value) for name, value in response.getheaders()
+                            if name not in SKIP_HEADERS and name not in HOP_HEADERS]
+        self.server.record(method, url, headers, data, response.status, response.reason, response_headers, body)
+        self.send(response.status, response_headers, body)
+
+    def send(self, status, headers, body):
+        self.send_response(status)
+        for name, value in headers:
+            if name.lower() not in SKIP_HEADERS:
+                self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        chunk_size = 16 * 1024
+        for i in range(0, len(body), chunk_size):
+            chunk = body[i:i+chunk_size]
+            time.sleep(float(len(chunk)) / bandwidth)
+            self.wfile.write(chunk)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+def start(server):
+    t = threading.Thread(target=server.serve_forever, name="replay")
+    t.daemon = True
+    t.start()
+    return server
+
+def run_crawlers(names, warcpaths, data_dir, workers=4, per_host=1, throttle_delay=0, **options):
+    """Runs the crawlers through a replay server of the WARC files and returns a report of the run.
+    """
+    recording = Recording()
+    for path in warcpaths:
+        recording.load(path)
+    server = start(ReplayServer(("127.0.0.1", 0), recording, **options))
+
+    old_proxy = os.environ.get("http_proxy")
+    old_delay = base.BaseCrawler.throttle_delay
+    os.environ["http_proxy"] = server.url
+    base.BaseCrawler.throttle_delay = throttle_delay
+    try:
+        t0 = time.time()
+        crawlers = scheduler.crawl(names, data_dir, workers, per_host)
+        elapsed = time.time() - t0
+    finally:
+        if old_proxy is None:
+            del os.environ["http_proxy"]
+        else:
+            os.environ["http_proxy"] = old_proxy
+        base.BaseCrawler.throttle_delay = old_delay
+        server.shutdown()
+        server.server_close()
+    return make_report(crawlers, elapsed)
+
+def make_report(crawlers, elapsed):
+    report = {"seconds": elapsed, "crawlers": {}}
+    for crawler in crawlers:
+        stats = crawler.metrics.requests.values()
+        report["crawlers"][os.path.basename(crawler.root)] = {
+            "requests": sum(s.requests for s in stats),
+            "errors": sum(s.errors for s in stats),
+            "bytes": sum(s.bytes for s in stats),
+        }
+    requests = sum(c["requests"] for c in report["crawlers"].values())
+    report["requests"] = requests
+    report["requests_per_second"] = elapsed and requests / elapsed or 0
+    return report
+
+def main():
+    parser = optparse.OptionParser(usage="%prog record|serve|run [options] file.warc.gz [...]")
+    parser.add_option("--port", type="int", default=8080, help="port of the server [default: %default]")
+    parser.add_option("--latency", type="float", default=0, help="seconds to wait before each response")
+    parser.add_option("--bandwidth", type="int", help="bytes per second sent for each response")
+    parser.add_option("--error-rate", type="float", default=0, help="fraction of the requests that fail")
+    parser.add_option("--rate-limit", type="float", help="requests per second allowed for each host")
+    parser.add_option("--seed", type="int", help="seed for the random errors")
+    parser.add_option("--crawlers", help="comma separated crawlers to run [default: all]")
+    parser.add_option("--data", help="directory to crawl into [default: a temporary directory]")
+    parser.add_option("--workers", type="int", default=4, help="number of jobs to run at a time [default: %default]")
+    parser.add_option("--per-host", type="int", default=1, help="number of jobs to run at a time on a host [default: %default]")
+    parser.add_option("-o", "--output", help="write the report of the run as JSON to this file")
+    options, args = parser.parse_args()
+    if len(args) < 2 or args[0] not in ["record", "serve", "run"]:
+        parser.error("a command and a WARC file are required")
+    command, warcpaths = args[0], args[1:]
+
+    FORMAT = "%(asctime)s [%(name)s] [%(threadName)s] [%(levelname)s] %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    server_options = dict(latency=options.latency, bandwidth=options.bandwidth, error_rate=options.error_rate,
+                          rate_limit=options.rate_limit, seed=options.seed)
+
+    if command == "record":
+        f = open(warcpaths[0], "ab")
+        try:
+            server = ReplayServer(("127.0.0.1", options.port), writer=WARCWriter(f))
+            logger.info("recording to %s, proxy at %s", warcpaths[0], server.url)
+            server.serve_forever()
+        finally:
+            f.close()
+    elif command == "serve":
+        recording = Recording()
+        for path in warcpaths:
+            recording.load(path)
+        server = ReplayServer(("127.0.0.1", options.port), recording, **server_options)
+        logger.info("replaying at %s", server.url)
+        server.serve_forever()
+    else:
+        names = options.crawlers and options.crawlers.split(",") or scheduler.discover()
+        data_dir = options.data or tempfile.mkdtemp()
+        try:
+            report = run_crawlers(names, warcpaths, data_dir, options.workers, options.per_host, **server_options)
+        finally:
+            if not options.data:
+                shutil.rmtree(data_dir)
+        print simplejson.dumps(report, indent=4)
+        if options.output:
+            with open(options.output, "w") as f:
+                f.write(simplejson.dumps(report, indent=4))
+
+class TestReplay:
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.warcpath = os.path.join(self.tmpdir, "x.warc.gz")
+        with open(self.warcpath, "wb") as f:
+            w = WARCWriter(f)
+            write_response(w, "GET", "http://example.com/a", "Content-Type: text/html\r\n", "page")
+            write_response(w, "POST", "http://example.com/a", "Content-Type: application/pdf\r\n", "pdf", "x=1&__VIEWSTATE=abc")
+        self.recording = Recording()
+        self.recording.load(self.warcpath)
+        self.servers = []
+
+    def teardown_method(self, method):
+        os.environ.pop("http_proxy", None)
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def start(self, **options):
+        server = start(ReplayServer(("127.0.0.1", 0), self.recording, **options))
+        self.servers.append(server)
+        return server
+
+    def make_crawler(self, server):
+        os.environ["http_proxy"] = server.url
+        class Crawler(base.BaseCrawler):
+            throttle_delay = 0
+        crawler = Crawler(os.path.join(self.tmpdir, "AE-2011-XX"))
+        crawler.retry_policy = RetryPolicy(retries=1, backoff=0.01)
+        return crawler
+
+    def test_replay(self):
+        crawler = self.make_crawler(self.start())
+        assert crawler.get("http://example.com/a", _cache=False) == "page"
+        assert crawler.post("http://example.com/a", {"x": "1"}) == "pdf"
+        try:
+            crawler.get("http://example.com/b")
+            assert False, "expected a 404"
+        except urllib2.HTTPError, e:
+            assert e.code == 404
+        assert crawler.metrics.requests["example.com", "-"].requests == 3
+
+    def test_errors(self):
+        crawler = self.make_crawler(self.start(error_rate=1.0, seed=1))
+        try:
+            crawler.get("http://example.com/a", _cache=False)
+            assert False, "expected an error"
+        except (urllib2.URLError, httplib.HTTPException):
+            pass
+        assert crawler.metrics.requests["example.com", "-"].errors == 2
+
+    def test_throttle_delay_restored(self):
+        def get_delay(crawler):
+            return [h.throttleDelay for h in crawler.opener.handlers if isinstance(h, ThrottlingProcessor)][0]
+        crawler = base.BaseCrawler(os.path.join(self.tmpdir, "AE-2011-YY"))
+        # the crawler finds nothing in the recording and gives up
+        run_crawlers(["AE_2011_PY"], [self.warcpath], os.path.join(self.tmpdir, "data"))
+        assert base.BaseCrawler.throttle_delay == 2
+        assert get_delay(crawler) == 2
+        assert get_delay(base.BaseCrawler(os.path.join(self.tmpdir, "AE-2011-ZZ"))) == 2
+
+    def test_rate_limit(self):
+        server = self.start(rate_limit=0.1)
+        opener = urllib2.build_opener(urllib2.ProxyHandler({"http": server.url}))
+        assert opener.open("http://example.com/a").read() == "page"
+        try:
+            opener.open("http://example.com/a")
+            assert False, "expected a 429"
+        except urllib2.HTTPError, e:
+            assert e.code == 429
+        # other hosts have their own limit
+        try:
+            opener.open("http://example.org/a")
+        except urllib2.HTTPError, e:
+            assert e.code == 404
+
+    def test_record(self):
+        upstream = self.start()
+        recorded = os.path.join(self.tmpdir, "recorded.warc.gz")
+        with open(recorded, "wb") as f:
+            recorder = start(ReplayServer(("127.0.0.1", 0), writer=WARCWriter(f)))
+            self.servers.append(recorder)
+            # the upstream server is reached through the recorder, as if it were the site
+            opener = urllib2.build_opener(urllib2.ProxyHandler({"http": recorder.url}))
+            url = upstream.url + "/a"
+            self.recording.add("GET", url, None, 200, [], "page")
+            self.recording.add("POST", url, "x=1", 200, [], "pdf")
+            assert opener.open(url).read() == "page"
+            assert opener.open(url, "x=1").read() == "pdf"
+
+        recording = Recording()
+        recording.load(recorded)
+        assert recording.get("GET", url, None)[2] == "page"
+        assert recording.get("POST", url, "x=1")[2] == "pdf"
+
+if __name__ == "__main__":
+    main()
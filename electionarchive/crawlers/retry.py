@@ -0,0 +1,116 @@
+"""Retries with exponential backoff and a per-host circuit breaker.
+
+RetryPolicy decides which errors are worth retrying and how long to wait
+before each retry. CircuitBreaker keeps track of consecutive failures of
+each host and stops sending requests to a host that keeps failing, so that
+the jobs of other hosts can continue. The host is tried again after
+reset_timeout seconds.
+"""
+import time
+import random
+import socket
+import httplib
+import urllib2
+import logging
+
+logger = logging.getLogger("retry")
+
+class HostUnavailable(urllib2.URLError):
+    """Raised when the circuit breaker of a host is open.
+    """
+    def __init__(self, host):
+        urllib2.URLError.__init__(self, "%s is unavailable" % host)
+        self.host = host
+
+class RetryPolicy:
+    """Retries failed requests with exponential backoff and jitter.
+    """
+    RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, retries=3, backoff=1.0, max_backoff=60.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def is_retryable(self, error):
+        if isinstance(error, HostUnavailable):
+            return False
+        elif isinstance(error, urllib2.HTTPError):
+            return error.code in self.RETRY_STATUSES
+        else:
+            # URLError wrapping a socket error, timeouts and broken responses
+            return isinstance(error, (urllib2.URLError, socket.error, httplib.HTTPException))
+
+    def get_delay(self, attempt):
+        """Returns the seconds to wait before the retry number attempt (starting from 0).
+
+        Half of the delay is random, so that the retries of many jobs don't hit the host at the same time.
+        """
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+class CircuitBreaker:
+    """Stops requests to a host after failure_threshold consecutive failures.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=300):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = {}
+        self.opened_at = {}
+
+    def allow(self, host):
+        """Returns True if a request can be sent to the host.
+
+        Once reset_timeout has passed after opening, a single trial request is allowed.
+        """
+        opened_at = self.opened_at.get(host)
+        if opened_at is None:
+            return True
+        if time.time() - opened_at >= self.reset_timeout:
+            # allow one request and keep the circuit open for the others
+            self.opened_at[host] = time.time()
+            return True
+        return False
+
+    def success(self, host):
+        self.failures.pop(host, None)
+        if self.opened_at.pop(host, None) is not None:
+            logger.info("%s is available again", host)
+
+    def failure(self, host):
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if self.failures[host] >= self.failure_threshold and host not in self.opened_at:
+            logger.warning("%s failed %d times, parking its requests for %ds", host, self.failures[host], self.reset_timeout)
+            self.opened_at[host] = time.time()
+
+    def reset(self):
+        self.failures.clear()
+        self.opened_at.clear()
+
+class TestRetry:
+    def test_is_retryable(self):
+        policy = RetryPolicy()
+        assert policy.is_retryable(urllib2.HTTPError("http://x/", 503, "Unavailable", {}, None))
+        assert not policy.is_retryable(urllib2.HTTPError("http://x/", 404, "Not Found", {}, None))
+        assert policy.is_retryable(urllib2.URLError(socket.timeout()))
+        assert policy.is_retryable(httplib.BadStatusLine(""))
+        assert not policy.is_retryable(HostUnavailable("x"))
+
+    def test_get_delay(self):
+        policy = RetryPolicy(backoff=1.0, max_backoff=4.0)
+        assert 0.5 <= policy.get_delay(0) <= 1.0
+        assert 1.0 <= policy.get_delay(1) <= 2.0
+        assert 2.0 <= policy.get_delay(5) <= 4.0
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+        breaker.failure("a")
+        assert breaker.allow("a")
+        breaker.failure("a")
+        assert "a" in breaker.opened_at
+        assert breaker.allow("b")
+
+        breaker.reset_timeout = 300
+        assert not breaker.allow("a")
+        breaker.success("a")
+        assert breaker.allow("a")
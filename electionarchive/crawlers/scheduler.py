@@ -0,0 +1,190 @@
+"""Runs all the crawlers in one process.
+
+The crawler modules in this directory (named like AE_2011_KL) are
+discovered and their work is put in a shared priority queue. The metadata
+of every election is crawled first and the file downloads are queued after
+it. Jobs are run by a pool of worker threads, with a limit on the number of
+concurrent jobs per host, so crawlers of different sites run side by side
+while each site is still throttled. A job counts against the one host it
+was queued for; see Scheduler.add_crawler.
+
+Usage:
+
+    python scheduler.py [--data data] [--workers 4] [--per-host 1] [AE_2011_KL ...]
+"""
+import os
+import re
+import heapq
+import urllib2
+import logging
+import optparse
+import pkgutil
+import threading
+import itertools
+
+logger = logging.getLogger("scheduler")
+
+METADATA = 0
+DOWNLOAD = 10
+
+RE_CRAWLER_MODULE = re.compile(r"^[A-Z]+_\d{4}_[A-Z]+$")
+
+def discover():
+    """Returns names of all the crawler modules.
+    """
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    return sorted(name for _, name, ispkg in pkgutil.iter_modules([dirname])
+                  if not ispkg and RE_CRAWLER_MODULE.match(name))
+
+def load_crawler(name, data_dir):
+    """Creates the crawler of the module, with root data_dir/<election id>.
+    """
+    module = __import__(name, globals())
+    return module.Crawler(os.path.join(data_dir, name.replace("_", "-")))
+
+def get_host(url):
+    return urllib2.Request(url).get_host()
+
+class Scheduler:
+    """Priority queue of jobs run by worker threads with per-host limits.
+
+    Among the jobs whose host is below its limit, the one with the lowest
+    priority number is run first, in the order they were added.
+    """
+    def __init__(self, workers=4, per_host=1):
+        self.workers = workers
+        self.per_host = per_host
+        self.queues = {}
+        self.active = {}
+        self.running = 0
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def add(self, priority, host, f):
+        with self.cond:
+            heapq.heappush(self.queues.setdefault(host, []), (priority, self.counter.next(), f))
+            self.cond.notify()
+
+    def _next_job(self):
+        """Waits for a job that can be run and returns (host, f). Returns None when all jobs are done.
+        """
+        with self.cond:
+            while True:
+                candidates = [(queue[0], host) for host, queue in self.queues.items()
+                              if queue and self.active.get(host, 0) < self.per_host]
+                if candidates:
+                    _, host = min(candidates)
+                    priority, _, f = heapq.heappop(self.queues[host])
+                    self.active[host] = self.active.get(host, 0) + 1
+                    self.running += 1
+                    return host, f
+                if self.running == 0:
+                    # nothing is running that could add more jobs
+                    self.cond.notify_all()
+                    return None
+                self.cond.wait()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            host, f = job
+            try:
+                f()
+            except Exception:
+                logger.error("job failed on %s", host, exc_info=True)
+            finally:
+                with self.cond:
+                    self.active[host] -= 1
+                    self.running -= 1
+                    self.cond.notify_all()
+
+    def run(self):
+        threads = [threading.Thread(target=self._worker) for i in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            # join with a timeout, so that KeyboardInterrupt gets through
+            while t.is_alive():
+                t.join(1)
+
+    def add_crawler(self, crawler):
+        """Queues the metadata crawl of the crawler, which queues its downloads when done.
+
+        The per-host limit counts a job against one host only: the host of
+        crawler.url for the metadata crawl and the host of the url for a
+        download. A job may fetch from other hosts too (the WB metadata crawl
+        reads both www.ceowb.in and ceowb.in), and those requests are not
+        counted by the scheduler. They are still spaced out by the ThrottlingProcessor
+        of the crawler, which keys on the host of every request.
+        """
+        def crawl_metadata():
+            crawler.crawl_metadata()
+            for url, download in crawler.get_downloads():
+                self.add(DOWNLOAD, get_host(url), download)
+        self.add(METADATA, get_host(crawler.url), crawl_metadata)
+
+def crawl(names, data_dir="data", workers=4, per_host=1):
+    """Runs the crawlers and returns them.
+    """
+    crawlers = [load_crawler(name, data_dir) for name in names]
+    scheduler = Scheduler(workers=workers, per_host=per_host)
+    for crawler in crawlers:
+        scheduler.add_crawler(crawler)
+    scheduler.run()
+
+    for crawler in crawlers:
+        crawler.run_parked()
+        crawler.metrics.log_summary()
+        crawler.metrics.dump(os.path.join(crawler.root, "metrics.json"))
+    return crawlers
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [crawler ...]")
+    parser.add_option("--data", default="data", help="directory to keep the crawled data [default: %default]")
+    parser.add_option("--workers", type="int", default=4, help="number of jobs to run at a time [default: %default]")
+    parser.add_option("--per-host", type="int", default=1, help="number of jobs to run at a time on a host [default: %default]")
+    options, args = parser.parse_args()
+
+    FORMAT = "%(asctime)s [%(name)s] [%(threadName)s] [%(levelname)s] %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    crawl(args or discover(), options.data, options.workers, options.per_host)
+
+class TestScheduler:
+    def test_discover(self):
+        assert discover() == ["AE_2011_KL", "AE_2011_PY", "AE_2011_WB"]
+
+    def test_priority(self):
+        done = []
+        scheduler = Scheduler(workers=1)
+        scheduler.add(DOWNLOAD, "a", lambda: done.append("download"))
+        scheduler.add(METADATA, "b", lambda: done.append("metadata"))
+        scheduler.run()
+        assert done == ["metadata", "download"]
+
+    def test_per_host(self):
+        lock = threading.Lock()
+        active = {}
+        peak = {}
+        def job(host):
+            def f():
+                with lock:
+                    active[host] = active.get(host, 0) + 1
+                    peak[host] = max(peak.get(host, 0), active[host])
+                threading.Event().wait(0.01)
+                with lock:
+                    active[host] -= 1
+            return f
+
+        scheduler = Scheduler(workers=4, per_host=1)
+        for i in range(5):
+            for host in ["a", "b"]:
+                scheduler.add(DOWNLOAD, host, job(host))
+        scheduler.run()
+        assert peak == {"a": 1, "b": 1}
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+"""WARC import and export of the HTTP cache and the downloaded files of a crawl.
+
+The cache/ directory of a crawler is exported as WARC response records and
+the files/ directory as resource records, in a gzipped WARC file with one
+gzip member per record. Importing the WARC file into another crawler root
+fills its cache and files, so that a crawl can be run there without
+fetching the pages again, or rebuilt offline.
+
+The url of a cache entry is in its <hash>.url file. Entries saved before
+the urls were kept are exported when their hash matches a url found in
+data.json or the data/ files of the crawler, the others are skipped.
+Imported files go through the blob store of the crawler root.
+
+Usage:
+
+    python warc.py export data/AE-2011-KL AE-2011-KL.warc.gz
+    python warc.py import data/AE-2011-KL AE-2011-KL.warc.gz [more.warc.gz ...]
+"""
+import os
+import sys
+import gzip
+import time
+import uuid
+import base64
+import shutil
+import hashlib
+import logging
+import itertools
+import urllib
+import tempfile
+import simplejson
+
+import datafile
+from blobstore import BlobStore
+from httpcache import CachedResponse, cache_key, legacy_cache_key
+
+logger = logging.getLogger("warc")
+
+WARC_VERSION = "WARC/1.0"
+
+# extension field with the path, relative to the crawler root, of an exported file
+FILENAME_HEADER = "X-Electionarchive-Filename"
+
+# the cached body is already decoded, so these headers don't apply to it any more
+SKIP_HEADERS = ["transfer-encoding", "content-encoding", "content-length"]
+
+def warc_date(t):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+
+def get_blobstore(root):
+    # same place as the blob store of the crawlers
+    return BlobStore(os.path.join(os.path.dirname(os.path.abspath(root)), "blobs"))
+
+class WARCWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write_record(self, type, block, headers=[], date=None):
+        """Writes a record and returns its WARC-Record-ID.
+        """
+        record_id = "<urn:uuid:%s>" % uuid.uuid4()
+        lines = [
+            WARC_VERSION,
+            "WARC-Type: " + type,
+            "WARC-Record-ID: " + record_id,
+            "WARC-Date: " + warc_date(date or time.time()),
+            "WARC-Block-Digest: sha1:" + base64.b32encode(hashlib.sha1(block).digest())]
+        lines += ["%s: %s" % (name, value) for name, value in headers]
+        lines.append("Content-Length: %d" % len(block))
+
+        # one gzip member per record, so that the records can be read independently
+        f = gzip.GzipFile(fileobj=self.fileobj, mode="wb")
+        f.write("\r\n".join(lines) + "\r\n\r\n")
+        f.write(block)
+        f.write("\r\n\r\n")
+        f.close()
+        return record_id
+
+def read_records(fileobj):
+    """Returns an iterator over (headers, block) of the records in a WARC file.
+
+    The names in headers are in lower case.
+    """
+    while True:
+        line = fileobj.readline()
+        if not line:
+            return
+        if not line.strip():
+            continue
+        if not line.startswith("WARC/"):
+            raise ValueError("bad WARC record: %r" % line)
+
+        headers = {}
+        for line in iter(fileobj.readline, "\r\n"):
+            if not line:
+                raise ValueError("truncated WARC record")
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        block = fileobj.read(int(headers["content-length"]))
+        fileobj.read(4) # \r\n\r\n
+        yield headers, block
+
+def iter_cache(cache_dir, known_urls={}):
+    """Returns an iterator over (url, data, headers, body path) of the cache entries with a known url.
+
+    data is the form data of cached POST requests and None for GET requests.
+    known_urls maps cache keys to urls, for the entries without a .url file.
+    """
+    if not os.path.exists(cache_dir):
+        return
+    skipped = 0
+    for f in sorted(os.listdir(cache_dir)):
+        if not f.endswith(".body"):
+            continue
+        hash = f[:-len(".body")]
+        path = os.path.join(cache_dir, hash)
+        if os.path.exists(path + ".url"):
+            url = open(path + ".url").read()
+        elif hash in known_urls:
+            url = known_urls[hash]
+        else:
+            logger.debug("skipping %s, its url is not known", path)
+            skipped += 1
+            continue
+        data = os.path.exists(path + ".data") and open(path + ".data").read() or None
+        yield url, data, open(path + ".headers").read(), path + ".body"
+    if skipped:
+        logger.warning("skipped %d entries of %s with unknown urls", skipped, cache_dir)
+
+def find_urls(value):
+    """Returns an iterator over the urls in a JSON value.
+
+        >>> list(find_urls({"a": ["http://x.com/1", {"b": "https://x.com/2"}], "c": "x"}))
+        ['http://x.com/1', 'https://x.com/2']
+    """
+    if isinstance(value, dict):
+        for k, v in sorted(value.items()):
+            for url in find_urls(v):
+                yield url
+    elif isinstance(value, list):
+        for v in value:
+            for url in find_urls(v):
+                yield url
+    elif isinstance(value, basestring) and (value.startswith("http://") or value.startswith("https://")):
+        yield value
+
+def get_known_urls(root):
+    """Returns a dict from cache key to url of the urls in data.json and the data/ files of root.
+
+    Both the current and the legacy keys of GET requests are included.
+    """
+    values = []
+    path = os.path.join(root, "data.json")
+    if os.path.exists(path):
+        values.append(datafile.read_header(path))
+        values = itertools.chain(values, datafile.iter_constituencies(path))
+
+    data_dir = os.path.join(root, "data")
+    if os.path.exists(data_dir):
+        paths = [os.path.join(data_dir, f) for f in sorted(os.listdir(data_dir)) if f.endswith(".json")]
+        values = itertools.chain(values, (simplejson.loads(open(p).read()) for p in paths))
+
+    urls = {}
+    for value in values:
+        for url in find_urls(value):
+            urls.setdefault(cache_key(url), url)
+            urls.setdefault(legacy_cache_key(url), url)
+    return urls
+
+def make_http_response(headers, body, status=200, reason="OK"):
+    lines = ["HTTP/1.1 %d %s" % (status, reason)]
+    for line in headers.splitlines():
+        if line.strip() and line.split(":", 1)[0].strip().lower() not in SKIP_HEADERS:
+            lines.append(line.rstrip())
+    lines.append("Content-Length: %d" % len(body))
+    return "\r\n".join(lines) + "\r\n\r\n" + body
+
+def parse_http_response(block):
+    """Returns status, headers and body of the HTTP response in a WARC response record.
+    """
+    head, body = block.split("\r\n\r\n", 1)
+    lines = head.split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = [line for line in lines[1:] if line.split(":", 1)[0].strip().lower() not in SKIP_HEADERS]
+    return status, "".join(line + "\r\n" for line in headers), body
+
+def get_selector(url):
+    return urllib.splithost(urllib.splittype(url)[1])[1] or "/"
+
+def make_http_request(method, url, headers, data):
+    lines = ["%s %s HTTP/1.1" % (method, get_selector(url))]
+    lines += ["%s: %s" % (name, value) for name, value in headers]
+    return "\r\n".join(lines) + "\r\n\r\n" + (data or "")
+
+def parse_http_request(block):
+    """Returns method and data of the HTTP request in a WARC request record.
+    """
+    head, data = block.split("\r\n\r\n", 1)
+    return head.split(" ", 1)[0], data or None
+
+def read_requests(warcpath):
+    """Returns a dict from the WARC-Record-ID of response records to (method, data) of their requests.
+
+    Responses without a request record are for GET requests.
+    """
+    requests = {}
+    f = gzip.open(warcpath)
+    try:
+        for headers, block in read_records(f):
+            if headers.get("warc-type") == "request" and "warc-concurrent-to" in headers:
+                requests[headers["warc-concurrent-to"]] = parse_http_request(block)
+    finally:
+        f.close()
+    return requests
+
+def write_response(writer, method, url, headers, body, data=None, status=200, reason="OK", request_headers=[], date=None):
+    """Writes a response record and, for requests other than GET, a request record with the data.
+    """
+    response_id = writer.write_record("response", make_http_response(headers, body, status, reason), [
+        ("WARC-Target-URI", url),
+        ("Content-Type", "application/http; msgtype=response")], date=date)
+    if method != "GET" or request_headers:
+        writer.write_record("request", make_http_request(method, url, request_headers, data), [
+            ("WARC-Target-URI", url),
+            ("WARC-Concurrent-To", response_id),
+            ("Content-Type", "application/http; msgtype=request")], date=date)
+
+def get_file_urls(root):
+    """Returns a dict from filename to url of the files in data.json of root.
+    """
+    path = os.path.join(root, "data.json")
+    if not os.path.exists(path):
+        return {}
+    urls = {}
+    for cons in datafile.iter_constituencies(path):
+        for c in cons.get('candidates', []):
+            for a in c.get('affidavits', []):
+                if a.get('filename') and a.get('url'):
+                    urls[a['filename']] = a['url']
+    return urls
+
+def export_warc(root, warcpath):
+    """Writes the cache and the files of crawler root into warcpath.
+
+    Returns the number of records written.
+    """
+    count = 0
+    with open(warcpath, "wb") as f:
+        w = WARCWriter(f)
+        w.write_record("warcinfo", "software: electionarchive\r\nformat: WARC File Format 1.0\r\n",
+                       [("Content-Type", "application/warc-fields")])
+
+        for url, data, headers, bodypath in iter_cache(os.path.join(root, "cache"), get_known_urls(root)):
+            method = data is None and "GET" or "POST"
+            write_response(w, method, url, headers, open(bodypath).read(), data, date=os.stat(bodypath).st_mtime)
+            count += 1
+
+        urls = get_file_urls(root)
+        files_dir = os.path.join(root, "files")
+        for dirpath, dirnames, filenames in os.walk(files_dir):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                filename = os.path.relpath(path, root)
+                headers = [(FILENAME_HEADER, filename), ("Content-Type", "application/octet-stream")]
+                if filename in urls:
+                    headers.insert(0, ("WARC-Target-URI", urls[filename]))
+                w.write_record("resource", open(path).read(), headers, date=os.stat(path).st_mtime)
+                count += 1
+    logger.info("exported %d records to %s", count, warcpath)
+    return count
+
+def import_warc(root, warcpath):
+    """Adds the responses and the files in warcpath to the cache and files of crawler root.
+
+    Returns the number of records imported.
+    """
+    cache_dir = os.path.join(root, "cache")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    blobstore = get_blobstore(root)
+    requests = read_requests(warcpath)
+
+    count = 0
+    f = gzip.open(warcpath)
+    try:
+        for headers, block in read_records(f):
+            type = headers.get("warc-type")
+            if type == "response" and headers.get("content-type", "").startswith("application/http"):
+                status, http_headers, body = parse_http_response(block)
+                method, data = requests.get(headers["warc-record-id"], ("GET", None))
+                if status != 200 or method not in ["GET", "POST"]:
+                    # the cache can only keep successful responses
+                    continue
+                if method == "POST":
+                    data = data or ""
+                CachedResponse.StoreContent(cache_dir, headers["warc-target-uri"], http_headers, body, data)
+                count += 1
+            elif type == "resource" and FILENAME_HEADER.lower() in headers:
+                filename = os.path.normpath(headers[FILENAME_HEADER.lower()])
+                if not filename.startswith("files" + os.sep):
+                    logger.warning("skipping %s, it is not under files/", filename)
+                    continue
+                blobstore.save(os.path.join(root, filename), block)
+                count += 1
+    finally:
+        f.close()
+    logger.info("imported %d records from %s", count, warcpath)
+    return count
+
+def main():
+    FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    if len(sys.argv) < 4 or sys.argv[1] not in ["import", "export"]:
+        print >> sys.stderr, __doc__
+        sys.exit(1)
+
+    command, root, paths = sys.argv[1], sys.argv[2], sys.argv[3:]
+    if command == "export":
+        export_warc(root, paths[0])
+    else:
+        for path in paths:
+            import_warc(root, path)
+
+class TestWARC:
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, "a", "AE-2011-XX")
+        cache_dir = os.path.join(self.root, "cache")
+        os.makedirs(cache_dir)
+        CachedResponse.StoreContent(cache_dir, "http://example.com/a?x=1",
+                                    "Content-Type: text/html\r\nTransfer-Encoding: chunked\r\n", "hello\r\n\r\nworld")
+        CachedResponse.StoreContent(cache_dir, "http://example.com/b", "Content-Type: application/pdf\r\n", "pdf",
+                                    data="__VIEWSTATE=abc&__EVENTTARGET=x")
+        get_blobstore(self.root).save(os.path.join(self.root, "files", "x", "1.pdf"), "pdf 1")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        warcpath = os.path.join(self.tmpdir, "x.warc.gz")
+        assert export_warc(self.root, warcpath) == 3
+
+        root = os.path.join(self.tmpdir, "b", "AE-2011-XX")
+        assert import_warc(root, warcpath) == 3
+
+        cache_dir = os.path.join(root, "cache")
+        response = CachedResponse(cache_dir, "http://example.com/a?x=1")
+        assert response.read() == "hello\r\n\r\nworld"
+        assert response.info()["content-type"] == "text/html"
+        assert "transfer-encoding" not in response.info()
+        assert open(os.path.join(cache_dir, cache_key("http://example.com/a?x=1") + ".url")).read() == "http://example.com/a?x=1"
+        assert open(os.path.join(root, "files", "x", "1.pdf")).read() == "pdf 1"
+        # the viewstate is not part of the key
+        assert CachedResponse(cache_dir, "http://example.com/b", data="__EVENTTARGET=x&__VIEWSTATE=def").read() == "pdf"
+
+    def test_known_urls(self):
+        # entries cached before the urls were saved
+        cache_dir = os.path.join(self.root, "cache")
+        for url, key in [("http://example.com/c?b=1&a=2", cache_key), ("http://example.com/d", legacy_cache_key),
+                         ("http://example.com/e", cache_key)]:
+            CachedResponse.StoreContent(cache_dir, url, "", url[-1])
+            os.remove(os.path.join(cache_dir, cache_key(url) + ".url"))
+            if key is legacy_cache_key:
+                for ext in [".headers", ".body"]:
+                    os.rename(os.path.join(cache_dir, cache_key(url) + ext), os.path.join(cache_dir, key(url) + ext))
+        datafile.write(os.path.join(self.root, "data.json"), {"url": "http://example.com/c?a=2&b=1", "constituencies": []})
+        os.makedirs(os.path.join(self.root, "data"))
+        with open(os.path.join(self.root, "data", "links.json"), "w") as f:
+            f.write(simplejson.dumps([{"url": "http://example.com/d"}]))
+
+        warcpath = os.path.join(self.tmpdir, "x.warc.gz")
+        # the 3 entries of setup_method and c and d, e is not known
+        assert export_warc(self.root, warcpath) == 5
+        urls = [h.get("warc-target-uri") for h, block in read_records(gzip.open(warcpath))]
+        assert "http://example.com/c?a=2&b=1" in urls and "http://example.com/d" in urls
+
+    def test_records(self):
+        warcpath = os.path.join(self.tmpdir, "x.warc.gz")
+        export_warc(self.root, warcpath)
+        records = list(read_records(gzip.open(warcpath)))
+        assert sorted(h["warc-type"] for h, block in records) == ["request", "resource", "response", "response", "warcinfo"]
+        assert "http://example.com/a?x=1" in [h.get("warc-target-uri") for h, block in records]
+        assert records[-1][1] == "pdf 1"
+
+if __name__ == "__main__":
+    main()
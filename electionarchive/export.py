@@ -0,0 +1,215 @@
+"""Exports all the crawled elections into columnar files for analysis.
+
+The candidates and the affidavits of all the elections are flattened into
+two Parquet files, with one row per candidate and one row per affidavit.
+Columns with few distinct values, like party, district and state, are
+dictionary encoded.
+
+Usage:
+
+    python export.py data export
+
+writes export/candidates.parquet and export/affidavits.parquet from all the
+data/*/data.json files.
+
+The exported files can be queried using count_by:
+
+    >>> count_by("export/candidates.parquet", ["state", "party"]) # doctest: +SKIP
+    {("Kerala", "INC"): 82, ...}
+"""
+import os
+import sys
+import glob
+import shutil
+import logging
+import tempfile
+import simplejson
+
+import numpy
+import pyarrow
+import pyarrow.parquet
+
+from crawlers import datafile
+
+logger = logging.getLogger("export")
+
+CANDIDATE_COLUMNS = [
+    "election_id", "state", "year", "election_type",
+    "district", "constituency_id", "constituency",
+    "candidate_id", "name", "party", "gender",
+]
+
+AFFIDAVIT_COLUMNS = [
+    "election_id", "state", "constituency_id", "candidate_id",
+    "name", "filename", "url",
+]
+
+# columns with few distinct values, stored dictionary encoded
+DICTIONARY_COLUMNS = {
+    "candidates": ["election_id", "state", "year", "election_type", "district", "party", "gender"],
+    "affidavits": ["election_id", "state", "name"],
+}
+
+def find_data_files(root):
+    return sorted(glob.glob(os.path.join(root, "*", "data.json")))
+
+def flatten(data):
+    """Returns the candidate rows and the affidavit rows of an election.
+    """
+    candidates, affidavits = [], []
+    for cons in data['constituencies']:
+        for c in cons.get('candidates', []):
+            candidates.append({
+                "election_id": data['_id'],
+                "state": data.get('state'),
+                "year": data.get('year'),
+                "election_type": data.get('election_type'),
+                "district": cons.get('district'),
+                "constituency_id": cons['id'],
+                "constituency": cons.get('name'),
+                "candidate_id": c.get('id'),
+                "name": c.get('name'),
+                "party": c.get('party'),
+                "gender": c.get('gender'),
+            })
+            for a in c.get('affidavits', []):
+                affidavits.append({
+                    "election_id": data['_id'],
+                    "state": data.get('state'),
+                    "constituency_id": cons['id'],
+                    "candidate_id": c.get('id'),
+                    "name": a.get('name'),
+                    "filename": a.get('filename'),
+                    "url": a.get('url'),
+                })
+    return candidates, affidavits
+
+def make_table(rows, columns, dictionary_columns):
+    arrays = []
+    for col in columns:
+        a = pyarrow.array([row[col] for row in rows], type=pyarrow.string())
+        if col in dictionary_columns:
+            a = a.dictionary_encode()
+        arrays.append(a)
+    return pyarrow.Table.from_arrays(arrays, columns)
+
+def export(root, outdir):
+    """Exports all the elections under root into outdir.
+
+    Each election is written as a separate row group, so only one election is in memory at a time.
+    """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    writers = {}
+    try:
+        for path in find_data_files(root):
+            logger.info("exporting %s", path)
+            data = datafile.read_header(path)
+            data['constituencies'] = datafile.iter_constituencies(path)
+            candidates, affidavits = flatten(data)
+
+            for name, rows, columns in [("candidates", candidates, CANDIDATE_COLUMNS),
+                                        ("affidavits", affidavits, AFFIDAVIT_COLUMNS)]:
+                if not rows:
+                    continue
+                table = make_table(rows, columns, DICTIONARY_COLUMNS[name])
+                if name not in writers:
+                    writers[name] = pyarrow.parquet.ParquetWriter(os.path.join(outdir, name + ".parquet"), table.schema)
+                writers[name].write_table(table)
+    finally:
+        for w in writers.values():
+            w.close()
+
+def _get_codes(column, value_index):
+    """Returns the values of a column as an array of integer codes.
+
+    The codes are indexes into value_index, which is extended with values not seen before.
+    """
+    codes = []
+    for chunk in column.chunks:
+        if not isinstance(chunk, pyarrow.DictionaryArray):
+            chunk = chunk.dictionary_encode()
+        # map the dictionary of the chunk to the global codes
+        mapping = numpy.array([value_index.setdefault(v, len(value_index)) for v in chunk.dictionary.to_pylist()] + [-1], dtype="int64")
+        indices = chunk.indices.to_numpy(zero_copy_only=False)
+        if chunk.indices.null_count:
+            # nulls come out as NaN, the last entry of mapping is the code of null
+            indices = numpy.where(numpy.isnan(indices), -1, indices)
+        codes.append(mapping[indices.astype("int64")])
+    if not codes:
+        return numpy.array([], dtype="int64")
+    return numpy.concatenate(codes)
+
+def count_by(path, columns, **filters):
+    """Counts the rows of an exported file grouped by the given columns.
+
+    Only the required columns are read from the file. Keyword arguments can
+    be used to filter the rows, e.g. count_by(path, ["party"], state="Kerala").
+
+    Returns a dict mapping tuple of column values to the count.
+    """
+    names = list(columns) + [c for c in filters if c not in columns]
+    table = pyarrow.parquet.read_table(path, columns=names, read_dictionary=names)
+
+    values = {}
+    codes = {}
+    for name in names:
+        values[name] = {}
+        codes[name] = _get_codes(table.column(name), values[name])
+
+    mask = numpy.ones(table.num_rows, dtype=bool)
+    for name, value in filters.items():
+        mask &= codes[name] == values[name].get(value, -2)
+
+    if not columns:
+        return {(): int(mask.sum())}
+
+    # combine the codes of all the columns into a single key and count the keys
+    # null is -1, shift by one to make all the codes positive
+    dims = [len(values[c]) + 1 for c in columns]
+    keys = numpy.ravel_multi_index([codes[c][mask] + 1 for c in columns], dims)
+    uniq, counts = numpy.unique(keys, return_counts=True)
+
+    labels = dict((c, [None] + sorted(values[c], key=values[c].get)) for c in columns)
+    result = {}
+    for key, count in zip(zip(*numpy.unravel_index(uniq, dims)), counts):
+        result[tuple(labels[c][i] for c, i in zip(columns, key))] = int(count)
+    return result
+
+def main():
+    FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+    export(sys.argv[1], sys.argv[2])
+
+class TestExport:
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        for eid, state, parties in [("AE-2011-XX", "X", ["P", "Q", "P", None]), ("AE-2011-YY", "Y", ["Q"])]:
+            os.makedirs(os.path.join(self.tmpdir, "data", eid))
+            data = {
+                "_id": eid,
+                "state": state,
+                "constituencies": [{
+                    "id": "1",
+                    "name": "C1",
+                    "candidates": [{"id": str(i), "name": "N%d" % i, "party": p, "affidavits": [{"name": "affidavit", "filename": "f"}]}
+                                   for i, p in enumerate(parties)]
+                }]
+            }
+            with open(os.path.join(self.tmpdir, "data", eid, "data.json"), "w") as f:
+                f.write(simplejson.dumps(data))
+        export(os.path.join(self.tmpdir, "data"), os.path.join(self.tmpdir, "export"))
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def test_count_by(self):
+        path = os.path.join(self.tmpdir, "export", "candidates.parquet")
+        assert count_by(path, ["state", "party"]) == {("X", "P"): 2, ("X", "Q"): 1, ("X", None): 1, ("Y", "Q"): 1}
+        assert count_by(path, ["party"], state="Y") == {("Q",): 1}
+        assert count_by(path, [], state="Z") == {(): 0}
+        assert count_by(os.path.join(self.tmpdir, "export", "affidavits.parquet"), ["name"]) == {("affidavit",): 5}
+
+if __name__ == "__main__":
+    main()
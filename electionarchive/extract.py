@@ -0,0 +1,202 @@
+"""Extracts the text of the affidavit PDFs of a crawl.
+
+The text of every file is extracted once, using pdftotext, and kept in
+<root>/text/<sha256>.txt, so a file downloaded for many candidates or
+downloaded again is not extracted again. The affidavit records in data.json
+get two optional fields: sha256 of the file and text, the path of the
+extracted text relative to root. The text itself is not put in data.json,
+as that would make the file many times bigger.
+
+The files are extracted in parallel by a pool of processes, one per core by
+default. When run again, only new and changed files are extracted. A file
+is known to be unchanged without reading it when it is still the hardlink
+to the blob of its recorded sha256.
+
+Usage:
+
+    python extract.py [-j 4] data/AE-2011-KL [data/AE-2011-PY ...]
+"""
+import os
+import shutil
+import logging
+import optparse
+import tempfile
+import subprocess
+import multiprocessing
+import simplejson
+
+from crawlers import datafile
+from crawlers.blobstore import BlobStore
+
+logger = logging.getLogger("extract")
+
+PDFTOTEXT = ["pdftotext", "-layout", "-enc", "UTF-8"]
+
+def get_blobstore(root):
+    # same place as the blob store of the crawlers
+    return BlobStore(os.path.join(os.path.dirname(os.path.abspath(root)), "blobs"))
+
+def iter_affidavits(constituencies):
+    for cons in constituencies:
+        for c in cons.get('candidates', []):
+            for a in c.get('affidavits', []):
+                if a.get('filename'):
+                    yield a
+
+def get_sha(root, affidavit, blobstore):
+    """Returns sha256 of the file of the affidavit or None if the file is not downloaded.
+    """
+    path = os.path.join(root, affidavit['filename'])
+    if not os.path.exists(path):
+        return None
+    sha = affidavit.get('sha256')
+    if sha and blobstore.exists(sha) and os.path.samefile(path, blobstore.blobpath(sha)):
+        return sha
+    return blobstore.hash_file(path)
+
+def get_textpath(sha):
+    return "text/%s.txt" % sha
+
+def extract_file(args):
+    """Extracts the text of a PDF into textpath. Returns None on success and the error message otherwise.
+
+    This runs in the worker processes, so it takes a single tuple.
+    """
+    pdfpath, textpath, command = args
+    tmp = textpath + ".tmp"
+    try:
+        p = subprocess.Popen(command + [pdfpath, tmp], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = p.communicate()
+    except OSError, e:
+        return "%s: %s" % (command[0], e)
+    if p.returncode != 0:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return err.strip() or "%s exited with %d" % (command[0], p.returncode)
+    os.rename(tmp, textpath)
+
+def extract(root, processes=None, command=PDFTOTEXT):
+    """Extracts the text of all the downloaded affidavits of root and updates data.json.
+
+    Returns the number of files extracted.
+    """
+    datapath = os.path.join(root, "data.json")
+    blobstore = get_blobstore(root)
+
+    if not os.path.exists(os.path.join(root, "text")):
+        os.makedirs(os.path.join(root, "text"))
+
+    # data.json is read one constituency at a time, keeping only the hashes
+    shas = {}
+    jobs = {}
+    for a in iter_affidavits(datafile.iter_constituencies(datapath)):
+        sha = get_sha(root, a, blobstore)
+        if sha is None:
+            continue
+        shas[a['filename']] = sha
+        textpath = os.path.join(root, get_textpath(sha))
+        if sha not in jobs and not os.path.exists(textpath):
+            jobs[sha] = (os.path.join(root, a['filename']), textpath, command)
+
+    logger.info("%d files to extract, %d already extracted", len(jobs), len(set(shas.values())) - len(jobs))
+    if jobs:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for (pdfpath, _, _), error in zip(jobs.values(), pool.map(extract_file, jobs.values())):
+                if error:
+                    logger.error("failed to extract %s: %s", pdfpath, error)
+        finally:
+            pool.close()
+            pool.join()
+
+    def update(cons):
+        """Updates sha256 and text of the affidavits of the constituency. Returns True if any of them changed."""
+        changed = False
+        for a in iter_affidavits([cons]):
+            sha = shas.get(a['filename'])
+            if sha is None:
+                continue
+            fields = {"sha256": sha}
+            if os.path.exists(os.path.join(root, get_textpath(sha))):
+                fields["text"] = get_textpath(sha)
+            elif "text" in a:
+                del a["text"]
+                changed = True
+            for k, v in fields.items():
+                if a.get(k) != v:
+                    a[k] = v
+                    changed = True
+        return changed
+
+    def updated_constituencies():
+        for cons in datafile.iter_constituencies(datapath):
+            update(cons)
+            yield cons
+
+    if any(update(cons) for cons in datafile.iter_constituencies(datapath)):
+        data = datafile.read_header(datapath)
+        data['constituencies'] = updated_constituencies()
+        datafile.write(datapath, data)
+    return len(jobs)
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] root [root ...]")
+    parser.add_option("-j", "--processes", type="int", help="number of processes to use [default: number of cores]")
+    options, args = parser.parse_args()
+
+    FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    for root in args:
+        extract(root, options.processes)
+
+class TestExtract:
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, "AE-2011-XX")
+        blobstore = get_blobstore(self.root)
+        blobstore.save(os.path.join(self.root, "files/1.pdf"), "text 1")
+        blobstore.save(os.path.join(self.root, "files/2.pdf"), "text 1")
+        self.affidavits = [
+            {"name": "a", "filename": "files/1.pdf"},
+            {"name": "b", "filename": "files/2.pdf"},
+            {"name": "c", "filename": "files/3.pdf"}]
+        data = {"constituencies": [{"candidates": [{"affidavits": self.affidavits}]}]}
+        with open(os.path.join(self.root, "data.json"), "w") as f:
+            f.write(simplejson.dumps(data))
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def extract(self):
+        # cp takes the same arguments as pdftotext and "extracts" the content as it is
+        count = extract(self.root, processes=2, command=["cp"])
+        return count, list(iter_affidavits(datafile.iter_constituencies(os.path.join(self.root, "data.json"))))
+
+    def test_extract(self):
+        count, affidavits = self.extract()
+        sha = BlobStore(None).hash("text 1")
+        assert count == 1
+        assert affidavits[0]["text"] == affidavits[1]["text"] == "text/%s.txt" % sha
+        assert affidavits[0]["sha256"] == sha
+        assert "text" not in affidavits[2]
+        assert open(os.path.join(self.root, affidavits[0]["text"])).read() == "text 1"
+
+    def test_incremental(self):
+        self.extract()
+        assert self.extract()[0] == 0
+
+        get_blobstore(self.root).save(os.path.join(self.root, "files/3.pdf"), "text 3")
+        count, affidavits = self.extract()
+        assert count == 1
+        assert open(os.path.join(self.root, affidavits[2]["text"])).read() == "text 3"
+
+    def test_failure(self):
+        count = extract(self.root, processes=1, command=["false"])
+        constituencies = datafile.iter_constituencies(os.path.join(self.root, "data.json"))
+        assert count == 1
+        assert [a.get("text") for a in iter_affidavits(constituencies)] == [None, None, None]
+        assert os.listdir(os.path.join(self.root, "text")) == []
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Packages a crawl into the zip that is uploaded to archive.org.
+
+The zip contains the files/ directory of a crawler root under a <eid>/
+prefix, which is the layout the download links on the constituency pages
+point to. data.json changes with every crawl and extraction, so it is kept
+out of the zip and copied next to it as <zip name>_data.json. A manifest
+with size and sha256 of every entry of the zip is written next to it too.
+
+Running it again on an existing zip appends only the new files, in place.
+The manifest is written last, after the zip is complete, so an entry is
+in the manifest only when it is complete in the zip. When a file in the
+zip has changed or has been deleted, or the zip doesn't match its
+manifest, as after a crash, the zip is rebuilt in a temp file and renamed
+into place.
+
+Usage:
+
+    python package.py data/AE-2011-KL [AE-2011-KL.zip]
+"""
+import os
+import sys
+import shutil
+import logging
+import hashlib
+import zipfile
+import tempfile
+import simplejson
+
+from crawlers.blobstore import mkstemp
+
+logger = logging.getLogger("package")
+
+def iter_files(root):
+    """Returns an iterator over paths, relative to root, of all the files to put in the zip.
+    """
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, "files")):
+        dirnames.sort()
+        for f in sorted(filenames):
+            yield os.path.relpath(os.path.join(dirpath, f), root)
+
+def hash_file(path):
+    """Returns size and sha256 of the file, reading it in chunks.
+    """
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), ""):
+            h.update(chunk)
+            size += len(chunk)
+    return size, h.hexdigest()
+
+def get_compression(filename):
+    # PDFs are already compressed, recompressing them only costs time
+    if filename.lower().endswith(".pdf"):
+        return zipfile.ZIP_STORED
+    else:
+        return zipfile.ZIP_DEFLATED
+
+def get_manifest_path(zippath):
+    return os.path.splitext(zippath)[0] + "_manifest.json"
+
+def get_data_path(zippath):
+    return os.path.splitext(zippath)[0] + "_data.json"
+
+def read_manifest(zippath):
+    """Returns the manifest of the zip, or None when the zip has to be rebuilt.
+    """
+    manifest_path = get_manifest_path(zippath)
+    if not os.path.exists(zippath) or not os.path.exists(manifest_path):
+        return None
+    manifest = simplejson.loads(open(manifest_path).read())
+    try:
+        zf = zipfile.ZipFile(zippath)
+        try:
+            names = zf.namelist()
+        finally:
+            zf.close()
+    except zipfile.BadZipfile:
+        logger.warning("%s is broken, rebuilding it", zippath)
+        return None
+    if sorted(names) != sorted(manifest):
+        # an earlier run failed after appending to the zip and before saving the manifest
+        logger.warning("%s doesn't match its manifest, rebuilding it", zippath)
+        return None
+    return manifest
+
+def package(root, zippath=None, eid=None):
+    """Writes files/ of root into zippath under eid/ and copies data.json next to it.
+
+    Returns the manifest.
+    """
+    eid = eid or os.path.basename(os.path.normpath(root))
+    zippath = zippath or eid + ".zip"
+    dirname = os.path.dirname(os.path.abspath(zippath))
+
+    entries = []
+    for relpath in iter_files(root):
+        size, sha = hash_file(os.path.join(root, relpath))
+        arcname = eid + "/" + relpath.replace(os.sep, "/")
+        entries.append((relpath, arcname, {"size": size, "sha256": sha}))
+
+    manifest = read_manifest(zippath)
+    if manifest:
+        current = dict((name, info) for relpath, name, info in entries)
+        changed = [name for name in manifest if current.get(name) != manifest[name]]
+        if changed:
+            logger.info("%d files changed or deleted since last packaging, rebuilding %s", len(changed), zippath)
+            manifest = None
+
+    if manifest is not None:
+        _write_zip(root, zippath, "a", entries, manifest)
+    else:
+        # write to a temp file, so that a failure doesn't leave a broken zip behind
+        manifest = {}
+        fd, tmp = mkstemp(dirname, suffix=".zip")
+        os.close(fd)
+        try:
+            _write_zip(root, tmp, "w", entries, manifest)
+            os.rename(tmp, zippath)
+        except:
+            os.remove(tmp)
+            raise
+
+    _save(get_manifest_path(zippath), simplejson.dumps(manifest, indent=4, sort_keys=True))
+    _save(get_data_path(zippath), open(os.path.join(root, "data.json")).read())
+    return manifest
+
+def _save(path, content):
+    fd, tmp = mkstemp(os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+def _write_zip(root, zippath, mode, entries, manifest):
+    zf = zipfile.ZipFile(zippath, mode, allowZip64=True)
+    try:
+        for relpath, arcname, info in entries:
+            if arcname in manifest:
+                continue
+            logger.info("adding %s", arcname)
+            # ZipFile.write streams the file from disk in small chunks
+            zf.write(os.path.join(root, relpath), arcname, get_compression(relpath))
+            manifest[arcname] = info
+    finally:
+        zf.close()
+
+def main():
+    FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    root = sys.argv[1]
+    zippath = len(sys.argv) > 2 and sys.argv[2] or None
+    package(root, zippath)
+
+class TestPackage:
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, "AE-2011-XX")
+        os.makedirs(os.path.join(self.root, "files", "a"))
+        self.write("data.json", "{}")
+        self.write("files/a/1.pdf", "pdf 1")
+        self.zippath = os.path.join(self.tmpdir, "AE-2011-XX.zip")
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, content):
+        with open(os.path.join(self.root, path), "w") as f:
+            f.write(content)
+
+    def namelist(self):
+        zf = zipfile.ZipFile(self.zippath)
+        try:
+            return [(i.filename, i.compress_type) for i in zf.infolist()]
+        finally:
+            zf.close()
+
+    def test_package(self):
+        manifest = package(self.root, self.zippath)
+        assert self.namelist() == [("AE-2011-XX/files/a/1.pdf", zipfile.ZIP_STORED)]
+        assert manifest["AE-2011-XX/files/a/1.pdf"] == {
+            "size": 5,
+            "sha256": hashlib.sha256("pdf 1").hexdigest()}
+        assert open(os.path.join(self.tmpdir, "AE-2011-XX_data.json")).read() == "{}"
+
+    def test_incremental(self):
+        package(self.root, self.zippath)
+        inode = os.stat(self.zippath).st_ino
+
+        # new files and a changed data.json are appended in place
+        self.write("files/a/2.pdf", "pdf 2")
+        self.write("data.json", "{1: 2}")
+        package(self.root, self.zippath)
+        assert len(self.namelist()) == 2
+        assert os.stat(self.zippath).st_ino == inode
+        assert open(os.path.join(self.tmpdir, "AE-2011-XX_data.json")).read() == "{1: 2}"
+
+        self.write("files/a/1.pdf", "pdf 1 again")
+        manifest = package(self.root, self.zippath)
+        assert len(self.namelist()) == 2
+        assert manifest["AE-2011-XX/files/a/1.pdf"]["size"] == 11
+        assert os.stat(self.zippath).st_ino != inode
+
+        os.remove(os.path.join(self.root, "files/a/2.pdf"))
+        manifest = package(self.root, self.zippath)
+        assert [name for name, compression in self.namelist()] == ["AE-2011-XX/files/a/1.pdf"]
+        assert sorted(manifest) == ["AE-2011-XX/files/a/1.pdf"]
+
+    def test_recovery(self):
+        package(self.root, self.zippath)
+        # as if a run had appended 2.pdf and failed before saving the manifest
+        self.write("files/a/2.pdf", "pdf 2")
+        zf = zipfile.ZipFile(self.zippath, "a")
+        zf.writestr("AE-2011-XX/files/a/2.pdf", "partial")
+        zf.close()
+        manifest = package(self.root, self.zippath)
+        assert len(self.namelist()) == 2
+        assert manifest["AE-2011-XX/files/a/2.pdf"]["size"] == 5
+
+        # a zip broken by a crash in the middle of appending
+        with open(self.zippath, "r+b") as f:
+            f.truncate(10)
+        package(self.root, self.zippath)
+        assert len(self.namelist()) == 2
+        assert sorted(os.listdir(self.tmpdir)) == ["AE-2011-XX", "AE-2011-XX.zip", "AE-2011-XX_data.json", "AE-2011-XX_manifest.json"]
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""Storage backends for the election archive.
+
+All the stores provide the same interface:
+
+    list() - ids of all the elections
+    get(id) - the election as a dict or None
+    get_constituency(eid, cid) - the constituency as a dict with its candidates or None
+    version(id=None) - a value that changes when the election (or the list of
+        elections when id is None) changes, None if the election is known not to exist
+
+The election returned by get may have only a summary of each constituency,
+without the candidates. Use get_constituency to get the full constituency.
+
+The SQLite store keeps elections, constituencies, candidates and affidavits
+in separate tables, so that a constituency page or a query across elections
+doesn't need to load whole elections. To import data.json files into it:
+
+    python storage.py elections.db data/AE-2011-KL/data.json data/AE-2011-PY/data.json
+"""
+import os
+import sys
+import shutil
+import urllib
+import urllib2
+import logging
+import sqlite3
+import tempfile
+import threading
+import simplejson
+
+from crawlers import datafile
+
+logger = logging.getLogger("storage")
+
+def get_store(url):
+    """Returns the store for the given url.
+
+    The url can be a path to a directory with <id>.json files, a path to a
+    SQLite database ending with .db or the url of a CouchDB database.
+    """
+    if url.startswith("http://") or url.startswith("https://"):
+        return CouchStore(url)
+    elif url.endswith(".db"):
+        return SQLiteStore(url)
+    else:
+        return JSONStore(url)
+
+class JSONStore:
+    """Store with each election in a JSON file <id>.json in a directory.
+    """
+    def __init__(self, root="db"):
+        self.root = root
+
+    def list(self):
+        return [os.path.splitext(f)[0] for f in os.listdir(self.root) if f.endswith(".json")]
+
+    def get(self, id):
+        filename = os.path.join(self.root, "%s.json" % id)
+        if os.path.exists(filename):
+            return simplejson.loads(open(filename).read())
+
+    def version(self, id=None):
+        if id is None:
+            path = self.root
+        else:
+            path = os.path.join(self.root, "%s.json" % id)
+        if os.path.exists(path):
+            return os.stat(path).st_mtime
+
+    def get_constituency(self, eid, cid):
+        d = self.get(eid)
+        for c in d and d['constituencies'] or []:
+            if c['id'] == cid:
+                return c
+
+    def find_candidates(self, party=None, election_id=None):
+        eids = election_id and [election_id] or self.list()
+        for eid in eids:
+            for cons in self.get(eid)['constituencies']:
+                for c in cons['candidates']:
+                    if party is None or c.get('party') == party:
+                        yield dict(c, election_id=eid, constituency_id=cons['id'])
+
+class SQLiteStore:
+    """Store with elections normalized into SQLite tables.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS elections (
+        id TEXT PRIMARY KEY,
+        name TEXT,
+        state TEXT,
+        election_type TEXT,
+        year TEXT,
+        url TEXT,
+        data TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS constituencies (
+        election_id TEXT,
+        id TEXT,
+        position INTEGER,
+        name TEXT,
+        district TEXT,
+        district_id TEXT,
+        category TEXT,
+        data TEXT,
+        PRIMARY KEY (election_id, id)
+    );
+
+    CREATE TABLE IF NOT EXISTS candidates (
+        election_id TEXT,
+        constituency_id TEXT,
+        id TEXT,
+        position INTEGER,
+        name TEXT,
+        party TEXT,
+        gender TEXT,
+        data TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS affidavits (
+        election_id TEXT,
+        constituency_id TEXT,
+        candidate_position INTEGER,
+        position INTEGER,
+        name TEXT,
+        filename TEXT,
+        url TEXT,
+        data TEXT
+    );
+
+    CREATE INDEX IF NOT EXISTS candidates_constituency_idx ON candidates (election_id, constituency_id, position);
+    CREATE INDEX IF NOT EXISTS candidates_party_idx ON candidates (party);
+    CREATE INDEX IF NOT EXISTS candidates_name_idx ON candidates (name);
+    CREATE INDEX IF NOT EXISTS constituencies_district_idx ON constituencies (district);
+    CREATE INDEX IF NOT EXISTS affidavits_candidate_idx ON affidavits (election_id, constituency_id, candidate_position);
+    """
+
+    ELECTION_COLUMNS = ["name", "state", "election_type", "year", "url"]
+    CONSTITUENCY_COLUMNS = ["name", "district", "district_id", "category"]
+    CANDIDATE_COLUMNS = ["name", "party", "gender"]
+    AFFIDAVIT_COLUMNS = ["name", "filename", "url"]
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.get_connection().executescript(self.SCHEMA)
+
+    def get_connection(self):
+        # sqlite connections can't be shared between threads
+        if not hasattr(self._local, "connection"):
+            self._local.connection = sqlite3.connect(self.path)
+            self._local.connection.row_factory = sqlite3.Row
+        return self._local.connection
+
+    def query(self, sql, *params):
+        return self.get_connection().execute(sql, params).fetchall()
+
+    def list(self):
+        return [row['id'] for row in self.query("SELECT id FROM elections ORDER BY id")]
+
+    def get(self, id):
+        rows = self.query("SELECT * FROM elections WHERE id=?", id)
+        if not rows:
+            return None
+        d = self._to_dict(rows[0], self.ELECTION_COLUMNS)
+        d['_id'] = d.pop('id')
+        rows = self.query("SELECT * FROM constituencies WHERE election_id=? ORDER BY position", id)
+        d['constituencies'] = [self._to_dict(row, self.CONSTITUENCY_COLUMNS) for row in rows]
+        return d
+
+    def version(self, id=None):
+        if id is not None and not self.query("SELECT id FROM elections WHERE id=?", id):
+            return None
+        # any import changes the modification time of the database file
+        return os.stat(self.path).st_mtime
+
+    def get_constituency(self, eid, cid):
+        rows = self.query("SELECT * FROM constituencies WHERE election_id=? AND id=?", eid, cid)
+        if not rows:
+            return None
+        d = self._to_dict(rows[0], self.CONSTITUENCY_COLUMNS)
+
+        affidavits = {}
+        for row in self.query("SELECT * FROM affidavits WHERE election_id=? AND constituency_id=? ORDER BY position", eid, cid):
+            a = self._to_dict(row, self.AFFIDAVIT_COLUMNS)
+            affidavits.setdefault(row['candidate_position'], []).append(a)
+
+        rows = self.query("SELECT * FROM candidates WHERE election_id=? AND constituency_id=? ORDER BY position", eid, cid)
+        d['candidates'] = [self._make_candidate(row, affidavits.get(row['position'], [])) for row in rows]
+        return d
+
+    def find_candidates(self, party=None, election_id=None):
+        """Returns candidates matching the given criteria across elections.
+
+        The affidavits are not included.
+        """
+        where, params = [], []
+        if party is not None:
+            where.append("party=?")
+            params.append(party)
+        if election_id is not None:
+            where.append("election_id=?")
+            params.append(election_id)
+        sql = "SELECT * FROM candidates"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        for row in self.query(sql, *params):
+            yield self._make_candidate(row, None)
+
+    def _make_candidate(self, row, affidavits):
+        c = self._to_dict(row, self.CANDIDATE_COLUMNS)
+        if affidavits is not None:
+            c['affidavits'] = affidavits
+        else:
+            c['election_id'] = row['election_id']
+            c['constituency_id'] = row['constituency_id']
+        return c
+
+    def _to_dict(self, row, columns):
+        keys = row.keys()
+        d = "data" in keys and simplejson.loads(row['data']) or {}
+        if "id" in keys:
+            d['id'] = row['id']
+        for c in columns:
+            if row[c] is not None:
+                d[c] = row[c]
+        return d
+
+    def _split(self, d, columns, exclude=()):
+        values = [d.get(c) for c in columns]
+        rest = dict((k, v) for k, v in d.items() if k not in columns and k not in exclude)
+        return values, simplejson.dumps(rest)
+
+    def import_election(self, data):
+        """Adds the election to the store, replacing the existing one with the same id.
+        """
+        eid = data['_id']
+        conn = self.get_connection()
+        with conn:
+            for table, column in [("elections", "id"), ("constituencies", "election_id"),
+                                  ("candidates", "election_id"), ("affidavits", "election_id")]:
+                conn.execute("DELETE FROM %s WHERE %s=?" % (table, column), (eid,))
+
+            values, rest = self._split(data, self.ELECTION_COLUMNS, ["_id", "_rev", "constituencies"])
+            conn.execute("INSERT INTO elections VALUES (?, ?, ?, ?, ?, ?, ?)", [eid] + values + [rest])
+
+            for i, cons in enumerate(data['constituencies']):
+                values, rest = self._split(cons, self.CONSTITUENCY_COLUMNS, ["id", "candidates"])
+                conn.execute("INSERT INTO constituencies VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [eid, cons['id'], i] + values + [rest])
+
+                for j, c in enumerate(cons['candidates']):
+                    values, rest = self._split(c, self.CANDIDATE_COLUMNS, ["id", "affidavits"])
+                    conn.execute("INSERT INTO candidates VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [eid, cons['id'], c.get('id'), j] + values + [rest])
+
+                    for k, a in enumerate(c.get('affidavits', [])):
+                        values, rest = self._split(a, self.AFFIDAVIT_COLUMNS)
+                        conn.execute("INSERT INTO affidavits VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [eid, cons['id'], j, k] + values + [rest])
+
+    def import_json(self, path):
+        """Imports the election from a data.json file.
+        """
+        logger.info("importing %s", path)
+        data = datafile.read_header(path)
+        data['constituencies'] = datafile.iter_constituencies(path)
+        self.import_election(data)
+
+class CouchStore:
+    """Store using the CouchDB documents created by couchload.
+    """
+    def __init__(self, db_url):
+        self.db_url = db_url.rstrip("/")
+
+    def _get(self, path):
+        try:
+            return simplejson.loads(urllib2.urlopen(self.db_url + path).read())
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return None
+            raise
+
+    def list(self):
+        rows = self._get("/_all_docs")['rows']
+        return [row['id'] for row in rows if "/" not in row['id']]
+
+    def get(self, id):
+        return self._get("/" + urllib.quote(id, safe=""))
+
+    def version(self, id=None):
+        # the documents of an election are saved separately, so any change to
+        # the database is considered a change to every election
+        return self._get("")['update_seq']
+
+    def get_constituency(self, eid, cid):
+        return self._get("/" + urllib.quote("%s/C%s" % (eid, cid), safe=""))
+
+def main():
+    FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
+    logging.basicConfig(format=FORMAT, level=logging.INFO)
+
+    store = SQLiteStore(sys.argv[1])
+    for path in sys.argv[2:]:
+        store.import_json(path)
+
+class TestSQLiteStore:
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = SQLiteStore(os.path.join(self.tmpdir, "elections.db"))
+        self.store.import_election({
+            "_id": "AE-2011-XX",
+            "state": "X",
+            "constituencies": [{
+                "id": "1",
+                "name": "Foo",
+                "district": "D",
+                "candidates": [{
+                    "id": "1",
+                    "name": "A",
+                    "party": "P",
+                    "download_url": "http://example.com/1",
+                    "affidavits": [{"name": "affidavit", "filename": "files/1.pdf", "sha256": "abc", "text": "text/abc.txt"}]
+                }, {
+                    "id": "2",
+                    "name": "B",
+                    "party": "Q",
+                    "affidavits": []
+                }]
+            }]
+        })
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get(self):
+        assert self.store.list() == ["AE-2011-XX"]
+        assert self.store.get("AE-2011-XX") == {
+            "_id": "AE-2011-XX",
+            "state": "X",
+            "constituencies": [{"id": "1", "name": "Foo", "district": "D"}]
+        }
+        assert self.store.get("AE-2011-YY") is None
+
+    def test_get_constituency(self):
+        c = self.store.get_constituency("AE-2011-XX", "1")
+        assert [x['name'] for x in c['candidates']] == ["A", "B"]
+        assert c['candidates'][0]['download_url'] == "http://example.com/1"
+        assert c['candidates'][0]['affidavits'] == [
+            {"name": "affidavit", "filename": "files/1.pdf", "sha256": "abc", "text": "text/abc.txt"}]
+        assert self.store.get_constituency("AE-2011-XX", "2") is None
+
+    def test_find_candidates(self):
+        assert [c['name'] for c in self.store.find_candidates(party="Q")] == ["B"]
+
+if __name__ == "__main__":
+    main()
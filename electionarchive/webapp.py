@@ -3,15 +3,170 @@
 
 import web
 import os
+import sys
+import gzip
+import shutil
+import hashlib
+import tempfile
+import mimetypes
+import StringIO
+import threading
+import collections
+import cProfile
 import simplejson
+import storage
+from crawlers.metrics import Metrics
+from crawlers.profiler import Profiler, pop_profile_option
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 urls = (
     "/", "index",
+    "/assets/([0-9a-f]+)/([^/]+)", "asset",
+    "/api/elections", "api_elections",
+    "/api/([^/]+)", "api_election",
+    "/api/([^/]+)/constituencies", "api_constituencies",
+    "/api/([^/]+)/C(\d+)", "api_constituency",
     "/([^/]*)", "election",
     "/([^/]*)/C(\d+)", "constituency",
 )
 app = web.application(urls, globals())
-render = web.template.render(os.path.join(os.path.dirname(__file__), "templates"))
+
+# directory of <id>.json files, a SQLite .db file or a CouchDB url
+store = storage.get_store(os.getenv("ELECTIONARCHIVE_DB", "db"))
+
+# time spent in rendering and compressing the pages
+metrics = Metrics()
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "static")
+
+# assets are served with their content hash in the url, so they can be cached for ever
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+def compress(body, encoding):
+    if encoding == "gzip":
+        out = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6, mtime=0)
+        f.write(body)
+        f.close()
+        return out.getvalue()
+    elif encoding == "br":
+        return brotli.compress(body)
+    else:
+        return body
+
+def negotiate_encoding(accept_encoding):
+    """Returns the best content encoding supported by the client from the Accept-Encoding header.
+    """
+    accepted = set()
+    for part in accept_encoding.split(","):
+        params = [p.strip() for p in part.split(";")]
+        if "q=0" in params or "q=0.0" in params:
+            continue
+        accepted.add(params[0].lower())
+        
+    if brotli and "br" in accepted:
+        return "br"
+    elif "gzip" in accepted:
+        return "gzip"
+    else:
+        return "identity"
+
+class CompressedEntry:
+    """Response body along with its compressed versions, which are created on first use.
+    """
+    def __init__(self, body):
+        self.bodies = {"identity": body}
+        
+    def get(self, encoding):
+        if encoding not in self.bodies:
+            with metrics.timer("compress"):
+                self.bodies[encoding] = compress(self.bodies["identity"], encoding)
+        return self.bodies[encoding]
+        
+class PageCache:
+    """LRU cache of rendered pages.
+    """
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+            
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        
+page_cache = PageCache()
+asset_cache = {}
+
+def send_body(entry):
+    """Sets the content encoding and returns the body best suited for the client.
+    """
+    encoding = negotiate_encoding(web.ctx.env.get("HTTP_ACCEPT_ENCODING", ""))
+    web.header("Vary", "Accept-Encoding")
+    if encoding != "identity":
+        web.header("Content-Encoding", encoding)
+    return entry.get(encoding)
+    
+def cached_page(version, render_page):
+    """Returns the page for the current path from the page cache, rendering it when it is not there.
+    
+    The version identifies the data used to render the page.
+    """
+    key = (web.ctx.path, version)
+    entry = page_cache.get(key)
+    if entry is None:
+        with metrics.timer("render"):
+            html = unicode(render_page()).encode("utf-8")
+        entry = page_cache.set(key, CompressedEntry(html))
+    web.header("Content-Type", "text/html; charset=utf-8")
+    return send_body(entry)
+    
+def cached_json(version, params, get_data):
+    """Like cached_page, but for JSON responses of the API.
+    
+    The params are the query parameters that affect the response.
+    """
+    key = (web.ctx.path, tuple(sorted(params.items())), version)
+    entry = page_cache.get(key)
+    if entry is None:
+        entry = page_cache.set(key, CompressedEntry(simplejson.dumps(get_data())))
+    web.header("Content-Type", "application/json")
+    return send_body(entry)
+    
+def get_asset(name):
+    """Returns (hash, entry) of the static file, reading it again only when it has changed.
+    """
+    path = os.path.join(STATIC_DIR, name)
+    mtime = os.stat(path).st_mtime
+    if name not in asset_cache or asset_cache[name][0] != mtime:
+        content = open(path).read()
+        asset_cache[name] = (mtime, hashlib.md5(content).hexdigest()[:12], CompressedEntry(content))
+    return asset_cache[name][1:]
+    
+def static_url(name):
+    """Returns url of the static file with its content hash."""
+    hash, entry = get_asset(name)
+    return "/assets/%s/%s" % (hash, name)
+
+render = web.template.render(os.path.join(os.path.dirname(__file__), "templates"), globals={"static_url": static_url})
 
 def first(seq):
     seq = iter(seq)
@@ -45,43 +200,331 @@ class Election:
         return self.data['constituencies']
         
     def get_constituency(self, cid):
-        return first(c for c in self.constituencies if c.id == cid)
+        c = first(c for c in self.constituencies if c.id == cid)
+        if c and "candidates" not in c:
+            # some stores provide only a summary of constituencies with the election
+            c = storify(store.get_constituency(self.id, cid))
+        return c
     
     @staticmethod
     def list():
         """Returns ids of all available elections.
         """
-        return [os.path.splitext(f)[0] for f in os.listdir("db") if f.endswith(".json")]
+        return store.list()
         
     @staticmethod
     def get(id):
         """Returns the election object with given id.
         """
-        filename = "db/%s.json" % id
-        if os.path.exists(filename):
-            json = open(filename).read()
-            data = simplejson.loads(json)
-            return data and Election(data)
+        data = store.get(id)
+        return data and Election(data)
+    
+def get_election(eid):
+    election = Election.get(eid)
+    if not election:
+        raise web.notfound()
+    return election
     
 class index:
     def GET(self):
-        elections = Election.list()
-        return render.site(render.index(elections))
+        def render_page():
+            elections = Election.list()
+            return render.site(render.index(elections))
+        return cached_page(store.version(), render_page)
         
 class election:
     def GET(self, eid):
-        election = Election.get(eid)
-        if not election:
+        version = store.version(eid)
+        if version is None:
             raise web.notfound()
-        return render.site(render.election(election))
+        def render_page():
+            election = get_election(eid)
+            return render.site(render.election(election))
+        return cached_page(version, render_page)
         
 class constituency:
     def GET(self, eid, cid):
-        election = Election.get(eid)
-        if not election:
+        version = store.version(eid)
+        if version is None:
+            raise web.notfound()
+        def render_page():
+            constituency = get_election(eid).get_constituency(cid)
+            if not constituency:
+                raise web.notfound()
+            return render.site(render.constituency(eid, constituency))
+        return cached_page(version, render_page)
+        
+class asset:
+    def GET(self, hash, name):
+        if not os.path.isfile(os.path.join(STATIC_DIR, name)):
+            raise web.notfound()
+        current_hash, entry = get_asset(name)
+        if hash == current_hash:
+            web.header("Cache-Control", "public, max-age=%d, immutable" % ASSET_MAX_AGE)
+        else:
+            # old url, the content has changed since
+            web.header("Cache-Control", "no-cache")
+        web.header("Content-Type", mimetypes.guess_type(name)[0] or "application/octet-stream")
+        return send_body(entry)
+        
+## JSON API
+
+# maximum number of constituencies returned in one request
+API_MAX_LIMIT = 1000
+
+# constituency fields that are not part of the summary of constituencies in some stores
+DETAIL_FIELDS = ["candidates"]
+
+def get_api_input(**defaults):
+    """Returns the query parameters, with fields as a list.
+    
+    offset and limit, when present, are converted to integers.
+    """
+    i = web.input(fields="", **defaults)
+    params = {"fields": i.fields}
+    try:
+        for name in defaults:
+            params[name] = int(i[name])
+    except ValueError:
+        raise web.badrequest()
+    return params
+    
+def project(d, fields):
+    """Returns only the specified fields of the dict, or all of them when fields is empty.
+    """
+    if not fields:
+        return d
+    return dict((f, d[f]) for f in fields if f in d)
+    
+def get_fields(params):
+    return [f for f in params['fields'].split(",") if f]
+    
+def get_constituency_fields(election):
+    """Returns the names of the fields that can be asked for in the constituencies of the election.
+    """
+    known = set(DETAIL_FIELDS)
+    for c in election.constituencies:
+        known.update(c)
+    return known
+    
+def check_fields(fields, known):
+    """Responds with 400 Bad Request when any of the fields is not known.
+    """
+    if any(f not in known for f in fields):
+        raise web.badrequest()
+    
+class api_elections:
+    def GET(self):
+        params = get_api_input()
+        return cached_json(store.version(), params, lambda: {"elections": Election.list()})
+        
+class api_election:
+    def GET(self, eid):
+        params = get_api_input()
+        version = store.version(eid)
+        if version is None:
+            raise web.notfound()
+        def get_data():
+            election = get_election(eid)
+            d = dict((k, v) for k, v in election.data.items() if k != "constituencies")
+            d['constituency_count'] = len(election.constituencies)
+            return project(d, get_fields(params))
+        return cached_json(version, params, get_data)
+        
+class api_constituencies:
+    def GET(self, eid):
+        params = get_api_input(offset=0, limit=100)
+        if params['offset'] < 0 or not 0 < params['limit'] <= API_MAX_LIMIT:
+            raise web.badrequest()
+        version = store.version(eid)
+        if version is None:
+            raise web.notfound()
+        def get_data():
+            election = get_election(eid)
+            fields = get_fields(params)
+            check_fields(fields, get_constituency_fields(election))
+            constituencies = election.constituencies[params['offset']:params['offset'] + params['limit']]
+            
+            def get_constituency(c):
+                if any(f in DETAIL_FIELDS and f not in c for f in fields):
+                    c = election.get_constituency(c.id)
+                elif not fields:
+                    # candidates are included only on request
+                    c = dict((k, v) for k, v in c.items() if k != "candidates")
+                return project(c, fields)
+            
+            return {
+                "offset": params['offset'],
+                "limit": params['limit'],
+                "total": len(election.constituencies),
+                "constituencies": [get_constituency(c) for c in constituencies]
+            }
+        return cached_json(version, params, get_data)
+        
+class api_constituency:
+    def GET(self, eid, cid):
+        params = get_api_input()
+        version = store.version(eid)
+        if version is None:
             raise web.notfound()
-        constituency = election.get_constituency(cid)
-        return render.site(render.constituency(eid, constituency))
+        def get_data():
+            election = get_election(eid)
+            constituency = election.get_constituency(cid)
+            if not constituency:
+                raise web.notfound()
+            fields = get_fields(params)
+            check_fields(fields, get_constituency_fields(election))
+            return project(constituency, fields)
+        return cached_json(version, params, get_data)
         
+def profile_processor(profiler, metrics):
+    """Returns a processor that profiles every request into profiler and times it in metrics.
+
+    The requests are handled in threads that the profiler of the main thread doesn't see.
+    """
+    def processor(handler):
+        p = cProfile.Profile()
+        try:
+            with metrics.timer("request"):
+                return p.runcall(handler)
+        finally:
+            profiler.add_stats(p)
+    return processor
+
+def main():
+    outdir = pop_profile_option(sys.argv)
+    if outdir is None:
+        app.run()
+        return
+
+    # in debug mode web.py runs the handlers from a re-imported copy of this
+    # module, which has its own metrics. run them from this module instead.
+    profiled_app = web.application(urls, globals(), autoreload=False)
+    profiler = Profiler(outdir)
+    profiled_app.add_processor(profile_processor(profiler, metrics))
+    profiler.start()
+    try:
+        profiled_app.run()
+    finally:
+        profiler.stop()
+        profiler.save(metrics)
+
+class TestWebapp:
+    def setup_method(self, method):
+        global store, metrics
+        metrics = Metrics()
+        self.tmpdir = tempfile.mkdtemp()
+        self.orig_store, store = store, storage.JSONStore(self.tmpdir)
+        page_cache.clear()
+        self.save("Foo", mtime=1000)
+
+    def teardown_method(self, method):
+        global store
+        store = self.orig_store
+        page_cache.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def save(self, name, mtime):
+        data = {
+            "_id": "AE-2011-XX",
+            "name": name,
+            "constituencies": [
+                {"id": str(i), "name": "C%d" % i, "district": "D", "candidates": [{"id": "1", "name": "N%d" % i, "party": "P", "affidavits": []}]}
+                for i in range(1, 6)]
+        }
+        path = os.path.join(self.tmpdir, "AE-2011-XX.json")
+        with open(path, "w") as f:
+            f.write(simplejson.dumps(data))
+        os.utime(path, (mtime, mtime))
+
+    def test_gzip(self):
+        response = app.request("/AE-2011-XX", headers={"Accept-Encoding": "deflate, gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert "Foo" in gzip.GzipFile(fileobj=StringIO.StringIO(response.data)).read()
+        # the compressed page is kept in the page cache
+        app.request("/AE-2011-XX", headers={"Accept-Encoding": "gzip"})
+        assert metrics.timers["compress"].count == 1
+
+        for accept_encoding in [None, "gzip;q=0", "deflate"]:
+            response = app.request("/AE-2011-XX", headers=accept_encoding and {"Accept-Encoding": accept_encoding} or {})
+            assert "Content-Encoding" not in response.headers
+            assert "Foo" in response.data
+
+    def test_assets(self):
+        response = app.request(static_url("style.css"))
+        assert response.status == "200 OK"
+        assert response.headers["Cache-Control"] == "public, max-age=%d, immutable" % ASSET_MAX_AGE
+        assert response.headers["Content-Type"] == "text/css"
+
+        # the url of an older version of the file
+        response = app.request("/assets/000000000000/style.css")
+        assert response.headers["Cache-Control"] == "no-cache"
+
+        assert app.request("/assets/000000000000/nosuchfile.css").status.startswith("404")
+
+    def test_invalidation(self):
+        assert "Foo" in app.request("/AE-2011-XX").data
+
+        # the page is served from the cache while the version is the same
+        self.save("Bar", mtime=1000)
+        assert "Foo" in app.request("/AE-2011-XX").data
+
+        self.save("Bar", mtime=2000)
+        assert "Bar" in app.request("/AE-2011-XX").data
+
+    def test_api_paging(self):
+        d = simplejson.loads(app.request("/api/AE-2011-XX/constituencies?offset=1&limit=2").data)
+        assert (d['offset'], d['limit'], d['total']) == (1, 2, 5)
+        assert [c['id'] for c in d['constituencies']] == ["2", "3"]
+        # candidates are left out unless they are asked for
+        assert "candidates" not in d['constituencies'][0]
+
+        d = simplejson.loads(app.request("/api/AE-2011-XX/constituencies?offset=4").data)
+        assert [c['id'] for c in d['constituencies']] == ["5"]
+
+        for query in ["offset=-1", "limit=0", "limit=%d" % (API_MAX_LIMIT + 1), "limit=x"]:
+            assert app.request("/api/AE-2011-XX/constituencies?" + query).status.startswith("400")
+
+    def test_api_fields(self):
+        global store
+        # the SQLite store has only a summary of the constituencies with the election
+        store = storage.SQLiteStore(os.path.join(self.tmpdir, "elections.db"))
+        store.import_json(os.path.join(self.tmpdir, "AE-2011-XX.json"))
+        fetched = []
+        get_constituency = store.get_constituency
+        store.get_constituency = lambda eid, cid: fetched.append(cid) or get_constituency(eid, cid)
+
+        d = simplejson.loads(app.request("/api/AE-2011-XX/constituencies?limit=2&fields=id,name").data)
+        assert d['constituencies'] == [{"id": "1", "name": "C1"}, {"id": "2", "name": "C2"}]
+        assert fetched == []
+
+        d = simplejson.loads(app.request("/api/AE-2011-XX/constituencies?limit=2&fields=name,candidates").data)
+        assert [c['candidates'][0]['name'] for c in d['constituencies']] == ["N1", "N2"]
+        assert fetched == ["1", "2"]
+
+        assert app.request("/api/AE-2011-XX/constituencies?fields=name,nosuchfield").status.startswith("400")
+
+        d = simplejson.loads(app.request("/api/AE-2011-XX/C2?fields=name,candidates").data)
+        assert d == {"name": "C2", "candidates": [{"id": "1", "name": "N2", "party": "P", "affidavits": []}]}
+        assert app.request("/api/AE-2011-XX/C2?fields=name,nosuchfield").status.startswith("400")
+        assert app.request("/api/AE-2011-XX/C9?fields=name").status.startswith("404")
+        assert app.request("/api/AE-2011-YY/constituencies").status.startswith("404")
+
+    def test_notfound(self):
+        assert app.request("/AE-2011-YY").status.startswith("404")
+        assert app.request("/AE-2011-XX/C9").status.startswith("404")
+        assert app.request("/AE-2011-XX/C1").status == "200 OK"
+
+    def test_profile_processor(self):
+        profiler = Profiler(self.tmpdir)
+        profiled_app = web.application(urls, globals(), autoreload=False)
+        profiled_app.add_processor(profile_processor(profiler, metrics))
+        assert profiled_app.request("/AE-2011-XX").status == "200 OK"
+        assert metrics.timers["request"].count == 1
+        # the handler ran in this module, so its render time is in the same metrics
+        assert metrics.timers["render"].count == 1
+        assert profiler.stats is not None
+
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    main()
\ No newline at end of file